@@ -2,11 +2,18 @@
 
 import logging
 import os.path
+import time
+from contextlib import contextmanager
+from itertools import islice, izip
 
 from common import URL, HTML
+from registry import get_backend, get_metadata
+from cache import BackendCache
+from metrics import METRICS, NULL_METRICS
+from tracing import TRACER, stage, record
 
 __all__ = ['Payment', 'URL', 'HTML', '__version__', 'SIPS', 'SYSTEMPAY',
-           'SPPLUS', 'DUMMY', 'get_backend']
+           'SPPLUS', 'DUMMY', 'get_backend', 'get_metadata', 'BackendCache']
 
 __version__ = "0.0.12"
 
@@ -18,10 +25,32 @@ SPPLUS = 'spplus'
 DUMMY = 'dummy'
 
 
-def get_backend(kind):
-    '''Resolve a backend name into a module object'''
-    module = __import__(kind, globals(), locals(), [])
-    return module.Payment
+# payment of the worker processes used by Payment.response_many()
+WORKER_PAYMENT = None
+
+
+def init_worker(kind, options):
+    global WORKER_PAYMENT
+    WORKER_PAYMENT = Payment(kind, dict(options))
+
+
+def timed(func, *args):
+    '''Call func in a worker process, return the start and end of the call
+       with its result or its exception, the parent process reports them'''
+    start = time.time()
+    try:
+        result, error = func(*args), None
+    except Exception as error:
+        result = None
+    return start, time.time(), result, error
+
+
+def worker_response(query_string):
+    return timed(WORKER_PAYMENT.backend.response, query_string)
+
+
+def worker_request(args):
+    return timed(WORKER_PAYMENT.backend.request_item, *args)
 
 
 class Payment(object):
@@ -64,12 +93,60 @@ class Payment(object):
            >>> print d['parameters']['cle']['caption']
            Secret Key
 
+       Backend modules are only imported when first used, the caption and
+       the parameter names of a backend are available without importing it:
+
+           >>> print eopayment.get_metadata(SPPLUS)['parameters']
+           ('cle', 'siret', 'langue', 'taxe', 'modalite', 'moyen')
+
+       When many Payment objects are created with the same options, for
+       example one by HTTP request, their backends can be shared using a
+       BackendCache:
+
+           >>> cache = eopayment.BackendCache(maxsize=512)
+           >>> p = Payment(kind=SPPLUS, options=spplus_options, cache=cache)
+
+       To answer repeated notifications of the same event without verifying
+       them again, give a notification store, see eopayment.store:
+
+           >>> store = SQLiteNotificationStore('/var/lib/app/notifications.db')
+           >>> p = Payment(kind=SPPLUS, options=spplus_options, store=store)
+
+       Durations and errors of the payment operations are reported to a
+       metrics collector, see eopayment.metrics:
+
+           >>> metrics = eopayment.metrics.MemoryMetrics()
+           >>> p = Payment(kind=SPPLUS, options=spplus_options, metrics=metrics)
+
+       To find which internal stage of the operations is slow, give a
+       tracer, see eopayment.tracing:
+
+           >>> recorder = eopayment.tracing.Recorder()
+           >>> p = Payment(kind=SPPLUS, options=spplus_options,
+                           tracer=recorder)
+
     '''
 
-    def __init__(self, kind, options, logger=LOGGER):
+    def __init__(self, kind, options, logger=LOGGER, cache=None, store=None,
+            metrics=None, tracer=None):
         self.logger = logger
         self.kind = kind
-        self.backend = get_backend(kind)(options, logger=logger)
+        self.store = store
+        self.metrics = metrics or NULL_METRICS
+        self.tracer = tracer
+        # backends consume some options, keep them for the worker processes
+        self.options = options.copy()
+        if metrics is not None or tracer is not None:
+            options = dict(options)
+            if metrics is not None:
+                options[METRICS] = metrics
+            if tracer is not None:
+                options[TRACER] = tracer
+        with stage(tracer, 'get_backend', backend=kind):
+            if cache is not None:
+                self.backend = cache.get(kind, options, logger)
+            else:
+                self.backend = get_backend(kind)(options, logger=logger)
 
     def request(self, amount, email=None, next_url=None):
         '''Request a payment to the payment backend.
@@ -102,7 +179,9 @@ class Payment(object):
                    # present the form in HTML to the user
 
         '''
-        return self.backend.request(amount, email=email, next_url=next_url)
+        with self.operation('request'):
+            return self.backend.request(amount, email=email,
+                                        next_url=next_url)
 
     def response(self, query_string):
         '''
@@ -121,6 +200,10 @@ class Payment(object):
           Arguments:
           query_string -- the URL encoded form-data from a GET or a POST
 
+          If the Payment has a notification store and the same event was
+          already notified, the stored response is returned with its
+          duplicate attribute set to True.
+
           It returns a quadruplet of values:
 
              (result, transaction_id, bank_data, return_content)
@@ -137,7 +220,190 @@ class Payment(object):
              your site as a web service.
 
         '''
-        return self.backend.response(query_string)
+        with self.operation('response'):
+            response = self.process(query_string)
+        return self.counted(response)
+
+    def accept(self, query_string, response):
+        '''Answer a notification already decoded by the backend, for example
+           by a router, as response() would'''
+        with self.operation('response'):
+            key = self.store_key(query_string)
+            stored = self.stored(key)
+            if stored is None:
+                stored = self.keep(key, response)
+        return self.counted(stored)
+
+    @contextmanager
+    def operation(self, name):
+        '''Time an operation of the payment and count its errors'''
+        with self.metrics.timer('eopayment_%s_seconds' % name,
+                                backend=self.kind), \
+                stage(self.tracer, name, backend=self.kind):
+            try:
+                yield
+            except Exception:
+                self.metrics.increment('eopayment_errors_total',
+                                       backend=self.kind, operation=name)
+                raise
+
+    def replay(self, name, start, end, result, error):
+        '''Report an operation run by a worker process like operation()
+           does, return its result or raise its exception'''
+        self.metrics.observe('eopayment_%s_seconds' % name, end - start,
+                             backend=self.kind)
+        record(self.tracer, name, start, end, error, backend=self.kind)
+        if error is not None:
+            self.metrics.increment('eopayment_errors_total',
+                                   backend=self.kind, operation=name)
+            raise error
+        return result
+
+    def counted(self, response):
+        '''Count a response and its signature failure'''
+        self.metrics.increment('eopayment_responses_total', backend=self.kind,
+                               signed=bool(response.signed))
+        if not response.signed:
+            self.metrics.increment('eopayment_signature_failures_total',
+                                   backend=self.kind)
+        return response
+
+    def store_key(self, query_string):
+        '''Key of a notification in the store, None if there is no store or
+           if the notification cannot be identified'''
+        if self.store is None:
+            return None
+        key = self.backend.notification_key(query_string)
+        if key is None:
+            return None
+        # merchants sharing a store can be given the same transaction ids
+        return (self.kind, self.backend.routing_key()) + key
+
+    def stored(self, key):
+        '''Return the stored response of a notification as a duplicate, or
+           None'''
+        if key is None:
+            return None
+        response = self.store.get(key)
+        if response is None:
+            return None
+        return response.copy(duplicate=True)
+
+    def keep(self, key, response):
+        '''Store the response of a notification if it is signed'''
+        if key is not None and response.signed:
+            self.store.add(key, response)
+        return response
+
+    def process(self, query_string):
+        '''Answer a notification from the store or from the backend'''
+        key = self.store_key(query_string)
+        response = self.stored(key)
+        if response is not None:
+            return response
+        return self.keep(key, self.backend.response(query_string))
+
+    def response_many(self, query_strings, processes=None, chunksize=100):
+        '''
+          Process an iterable of responses from the Bank API, for example a
+          log of notifications to replay, and lazily yield a PaymentResponse
+          for each of them in the same order.
+
+          Arguments:
+          query_strings -- an iterable of URL encoded form-data
+          processes -- if not None, the number of worker processes among
+          which the query strings are distributed
+          chunksize -- number of query strings sent at once to a worker
+          process, at most processes * chunksize query strings are read in
+          advance from the iterable
+
+          With a notification store, the store is looked up and filled by
+          the current process, the workers only verify the notifications
+          missing from it. Durations, errors and signature failures of the
+          workers are reported to the metrics and the tracer of the Payment.
+
+        '''
+        if not processes:
+            for query_string in query_strings:
+                yield self.response(query_string)
+            return
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, init_worker,
+                (self.kind, self.options))
+        try:
+            query_strings = iter(query_strings)
+            while True:
+                batch = list(islice(query_strings, processes * chunksize))
+                if not batch:
+                    break
+                keys = [self.store_key(query_string)
+                        for query_string in batch]
+                missing = [self.stored(key) is None for key in keys]
+                responses = pool.imap(worker_response, [query_string
+                        for query_string, miss in izip(batch, missing)
+                        if miss], chunksize)
+                for query_string, key, miss in izip(batch, keys, missing):
+                    outcome = responses.next() if miss else None
+                    # an earlier notification of the batch may have been
+                    # stored since
+                    if outcome is None or self.stored(key) is not None:
+                        yield self.response(query_string)
+                    else:
+                        response = self.replay('response', *outcome)
+                        yield self.counted(self.keep(key, response))
+        finally:
+            pool.terminate()
+
+    def request_many(self, items, processes=None, chunksize=100):
+        '''
+          Request many payments at once, for example to send a payment link
+          with each invoice of a batch, and lazily yield the (transaction_id,
+          kind, data) triple of each of them in the same order.
+
+          Arguments:
+          items -- an iterable of (amount, email, next_url) tuples, a fourth
+          element can give a dictionary of backend specific arguments
+          processes -- if not None, the number of worker processes among
+          which the requests are distributed
+          chunksize -- number of requests sent at once to a worker process
+
+          Transaction ids are allocated by batches in the current process,
+          the workers only build and sign the requests.
+
+           >>> items = ((invoice.amount, invoice.email, None)
+                        for invoice in invoices)
+           >>> for invoice, (transaction_id, kind, data) in zip(invoices,
+                   processor.request_many(items)):
+                   invoice.add_transaction_id(transaction_id)
+
+        '''
+        backend = self.backend
+        args = backend.transaction_id_args()
+        pool = None
+        if processes:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes, init_worker,
+                    (self.kind, self.options))
+        try:
+            items = iter(items)
+            while True:
+                batch = list(islice(items, (processes or 1) * chunksize))
+                if not batch:
+                    break
+                ids = backend.allocator.allocate_many(len(batch), *args)
+                if pool is None:
+                    for item, transaction_id in izip(batch, ids):
+                        with self.operation('request'):
+                            result = backend.request_item(item,
+                                                          transaction_id)
+                        yield result
+                else:
+                    for outcome in pool.imap(worker_request,
+                            izip(batch, ids), chunksize):
+                        yield self.replay('request', *outcome)
+        finally:
+            if pool is not None:
+                pool.terminate()
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
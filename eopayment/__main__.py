@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+'''Maintenance commands, run them with python -m eopayment <command>'''
+
+import optparse
+import sys
+
+from allocator import ALLOCATORS, ALLOCATOR, ALLOCATOR_PATH, get_allocator
+from common import PaymentCommon
+
+USAGE = '''%prog <command> [options]
+
+Commands:
+  purge    remove transaction id reservations older than the retention period'''
+
+
+def purge(options):
+    allocator = get_allocator({ALLOCATOR: options.allocator,
+                               ALLOCATOR_PATH: options.path},
+                              PaymentCommon.PATH)
+    report = allocator.purge(options.retention)
+    print 'removed %d reservations in %.3f seconds' % report
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage=USAGE, prog='python -m eopayment')
+    parser.add_option('--allocator', default='file',
+                      choices=sorted(ALLOCATORS.keys()),
+                      help='kind of allocator (default: %default)')
+    parser.add_option('--path', default=PaymentCommon.PATH,
+                      help='directory or database of the allocator '
+                           '(default: %default)')
+    parser.add_option('--retention', type='int', default=7,
+                      help='number of days of reservations to keep '
+                           '(default: %default)')
+    options, args = parser.parse_args(args)
+    if args != ['purge']:
+        parser.error('unknown command')
+    purge(options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
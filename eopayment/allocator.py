@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+
+'''Allocators of transaction identifiers
+
+An allocator reserves the transaction identifiers emitted by the backends and
+guarantees that an identifier is never given twice during the same day for
+the same prefixes. The allocator of a backend is chosen with the
+`transaction_id_allocator` option, which can be an allocator instance or the
+name of one of the allocators provided:
+
+ - file, the historical allocator, it creates one file per identifier in a
+   directory (PaymentCommon.PATH by default),
+ - sharded_file, like file but files are created in one subdirectory per day,
+ - memory, an in-process allocator, identifiers are only unique inside the
+   current process,
+ - sqlite, reservations are kept in a SQLite database, all the workers using
+   the same database file share the same identifiers space,
+ - sequence, identifiers are sequential numbers, each process leases blocks
+   of numbers from a SQLite database and emits them from memory. Numbers
+   restart every day and are predictable, the backends whose identifiers
+   must stay unique across days (spplus, dummy) refuse it.
+
+The `transaction_id_path` option gives the directory or the database file
+used by the file, sqlite and sequence allocators.
+
+Reservations are never needed after their day, allocators provide a purge()
+method to remove those older than a retention period, it is also available
+from the command line:
+
+    python -m eopayment purge --allocator file --path /tmp --retention 7
+'''
+
+import errno
+import os
+import os.path
+import random
+import re
+import stat
+import threading
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+
+
+__all__ = ['Allocator', 'FileAllocator', 'MemoryAllocator',
+           'SQLiteAllocator', 'SequenceAllocator', 'ShardedFileAllocator',
+           'ALLOCATORS', 'PurgeReport', 'get_allocator']
+
+RANDOM = random.SystemRandom()
+
+ALLOCATOR = 'transaction_id_allocator'
+ALLOCATOR_PATH = 'transaction_id_path'
+SQLITE_FILENAME = 'eopayment-transaction-id.sqlite3'
+# names of the files created by FileAllocator (day, prefixes and id), of the
+# per-day directories of ShardedFileAllocator and of the files they contain
+FILE_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})_[\w.-]*_\w+$')
+DAY_DIRECTORY_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})$')
+SHARD_FILE_RE = re.compile(r'^[\w.-]*_\w+$')
+
+PurgeReport = namedtuple('PurgeReport', 'removed elapsed')
+
+
+def cutoff(retention, today=None):
+    '''Return the first day to keep as a string'''
+    today = today or date.today()
+    return str(today - timedelta(days=retention))
+
+
+class Allocator(object):
+    '''Base class of the allocators, subclasses must implement reserve()'''
+    # identifiers are only unique during their day
+    SEQUENTIAL = False
+
+    def allocate(self, length, choices, *prefixes):
+        '''Draw random identifiers of length characters taken in choices
+           until one can be reserved.'''
+        while True:
+            id = ''.join([RANDOM.choice(choices) for x in range(length)])
+            if self.reserve(id, *prefixes):
+                return id
+
+    def allocate_many(self, count, length, choices, *prefixes):
+        '''Return a list of count new identifiers, subclasses can reserve
+           them at once'''
+        return [self.allocate(length, choices, *prefixes)
+                for i in xrange(count)]
+
+    def reserve(self, id, *prefixes):
+        '''Reserve id for today, return False if it is already taken'''
+        raise NotImplementedError
+
+    def purge(self, retention, today=None):
+        '''Remove the reservations older than retention days, return a
+           PurgeReport giving the number of removed reservations and the
+           time it took'''
+        raise NotImplementedError
+
+
+class FileAllocator(Allocator):
+    '''Reserve identifiers by creating a file named after them'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def filename(self, id, *prefixes):
+        name = '%s_%s_%s' % (str(date.today()), '-'.join(prefixes), str(id))
+        return os.path.join(self.path, name)
+
+    def reserve(self, id, *prefixes):
+        try:
+            fd = os.open(self.filename(id, *prefixes),
+                         os.O_CREAT | os.O_EXCL)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        os.close(fd)
+        return True
+
+    def unlink_reservation(self, path):
+        '''Remove path if it looks like a reservation file, an empty regular
+           file, return whether it was removed'''
+        try:
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode) or st.st_size:
+                return False
+            os.unlink(path)
+        except OSError, e:
+            # removed by a concurrent purge
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def purge(self, retention, today=None):
+        '''Remove reservation files and per-day directories of the days
+           before the retention period. The directory can be shared, only
+           the entries named like the ones created by the allocators are
+           considered and anything else they contain is left in place.'''
+        start = time.time()
+        first_day = cutoff(retention, today)
+        removed = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            m = FILE_RE.match(name)
+            if m:
+                if m.group(1) < first_day:
+                    removed += self.unlink_reservation(path)
+                continue
+            m = DAY_DIRECTORY_RE.match(name)
+            if not m or m.group(1) >= first_day or os.path.islink(path) \
+                    or not os.path.isdir(path):
+                continue
+            for filename in os.listdir(path):
+                if SHARD_FILE_RE.match(filename):
+                    removed += self.unlink_reservation(
+                            os.path.join(path, filename))
+            try:
+                os.rmdir(path)
+            except OSError, e:
+                # other entries were left in the directory
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST,
+                                   errno.ENOENT):
+                    raise
+        return PurgeReport(removed, time.time() - start)
+
+
+class ShardedFileAllocator(FileAllocator):
+    '''Reserve identifiers by creating files in one directory per day, so
+       that directories stay small and old days can be removed at once'''
+
+    def filename(self, id, *prefixes):
+        name = '%s_%s' % ('-'.join(prefixes), str(id))
+        return os.path.join(self.path, str(date.today()), name)
+
+    def reserve(self, id, *prefixes):
+        try:
+            return super(ShardedFileAllocator, self).reserve(id, *prefixes)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        try:
+            os.mkdir(os.path.join(self.path, str(date.today())))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        return super(ShardedFileAllocator, self).reserve(id, *prefixes)
+
+
+class MemoryAllocator(Allocator):
+    '''Reserve identifiers in a dictionary of the current process.
+
+       dict.setdefault() is atomic, so no lock is needed to share an
+       instance between threads: the reservations of each day are in a
+       dictionary created by setdefault(), threads starting a new day at
+       the same time get the same one.
+    '''
+
+    def __init__(self, path=None):
+        self.days = {}
+
+    def reserve(self, id, *prefixes):
+        today = date.today()
+        reserved = self.days.get(today)
+        if reserved is None:
+            reserved = self.days.setdefault(today, {})
+            for day in self.days.keys():
+                if day != today:
+                    self.days.pop(day, None)
+        token = object()
+        return reserved.setdefault((prefixes, id), token) is token
+
+    def purge(self, retention, today=None):
+        # reservations of previous days are dropped at the first
+        # reservation of a new day
+        return PurgeReport(0, 0.0)
+
+
+class SQLiteDatabase(object):
+    '''Give one connection by thread and by process to a SQLite database
+       whose tables are created by SCHEMA'''
+    SCHEMA = None
+    FILENAME = 'eopayment.sqlite3'
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, self.FILENAME)
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        # connections cannot be shared between threads nor inherited by a
+        # forked process
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            import sqlite3
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            connection.execute(self.SCHEMA)
+            self.local.connection, self.local.pid = connection, pid
+        return self.local.connection
+
+
+class DailySQLiteAllocator(SQLiteDatabase, Allocator):
+    '''Base class of the allocators keeping rows by day in the table TABLE
+       of a SQLite database'''
+    FILENAME = SQLITE_FILENAME
+    TABLE = None
+
+    def purge(self, retention, today=None):
+        start = time.time()
+        cursor = self.connection.execute('DELETE FROM %s WHERE day < ?'
+                                         % self.TABLE,
+                                         (cutoff(retention, today),))
+        return PurgeReport(cursor.rowcount, time.time() - start)
+
+
+class SQLiteAllocator(DailySQLiteAllocator):
+    '''Reserve identifiers as rows of a SQLite table, the primary key on
+       (day, prefix, id) guarantees unicity between processes.'''
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS transaction_id ('
+              'day TEXT, prefix TEXT, id TEXT, '
+              'PRIMARY KEY (day, prefix, id))')
+    TABLE = 'transaction_id'
+
+    def reserve(self, id, *prefixes):
+        import sqlite3
+        try:
+            self.connection.execute(
+                'INSERT INTO transaction_id VALUES (?, ?, ?)',
+                (str(date.today()), '-'.join(prefixes), str(id)))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def allocate_many(self, count, length, choices, *prefixes):
+        '''Reserve the identifiers in a single transaction, so that the
+           database is synced once for all of them'''
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            ids = super(SQLiteAllocator, self).allocate_many(count, length,
+                    choices, *prefixes)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return ids
+
+
+def encode(number, length, choices):
+    '''Write number in base len(choices) using choices as digits'''
+    base = len(choices)
+    digits = []
+    for i in range(length):
+        number, digit = divmod(number, base)
+        digits.append(choices[digit])
+    return ''.join(reversed(digits))
+
+
+class SequenceAllocator(DailySQLiteAllocator):
+    '''Emit sequential identifiers from blocks leased in a SQLite database.
+
+       Each process leases block_size numbers at a time from the counter of
+       the day and hands them out from memory, so the database is only
+       touched once per block. Numbers of a block not used by a process are
+       lost, the whole space of identifiers is len(choices) ** length
+       numbers per day and per prefixes.
+    '''
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS transaction_id_sequence ('
+              'day TEXT, prefix TEXT, next INTEGER, '
+              'PRIMARY KEY (day, prefix))')
+    TABLE = 'transaction_id_sequence'
+    BLOCK_SIZE = 100
+    SEQUENTIAL = True
+
+    def __init__(self, path, block_size=BLOCK_SIZE):
+        super(SequenceAllocator, self).__init__(path)
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.pid = None
+        self.blocks = {}
+        self.issued = 0
+
+    def lease(self, prefix, capacity, count, partial=True):
+        '''Reserve the next count numbers of the day in the database,
+           return the day and the range of numbers as a triple. Near the
+           capacity the range is shorter, unless partial is False: nothing
+           is reserved then.'''
+        day = str(date.today())
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT next FROM transaction_id_sequence '
+                                     'WHERE day = ? AND prefix = ?',
+                                     (day, prefix)).fetchone()
+            start = row[0] if row else 0
+            if start >= capacity or (not partial and
+                                     capacity - start < count):
+                raise RuntimeError('all transaction ids of the day have been '
+                                   'allocated for %r' % prefix)
+            end = min(start + count, capacity)
+            connection.execute('INSERT OR REPLACE INTO transaction_id_sequence '
+                               'VALUES (?, ?, ?)', (day, prefix, end))
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return day, start, end
+
+    def allocate(self, length, choices, *prefixes):
+        prefix = '-'.join(prefixes)
+        with self.lock:
+            # blocks must not be shared with a forked process
+            if self.pid != os.getpid():
+                self.pid, self.blocks = os.getpid(), {}
+            block = self.blocks.get(prefix)
+            if block is None or block[1] >= block[2] \
+                    or block[0] != str(date.today()):
+                block = list(self.lease(prefix, len(choices) ** length,
+                                        self.block_size))
+                self.blocks[prefix] = block
+            number = block[1]
+            block[1] += 1
+            self.issued += 1
+        return encode(number, length, choices)
+
+    def reserve(self, id, *prefixes):
+        '''Identifiers are not recorded one by one, only the counter of the
+           day is, so an arbitrary identifier cannot be reserved'''
+        raise NotImplementedError('the sequence allocator cannot reserve a '
+                                  'given identifier')
+
+    def allocate_many(self, count, length, choices, *prefixes):
+        '''Lease a block of count numbers, the block of the process is left
+           untouched'''
+        day, start, end = self.lease('-'.join(prefixes), len(choices) ** length,
+                count, partial=False)
+        with self.lock:
+            self.issued += count
+        return [encode(number, length, choices)
+                for number in xrange(start, end)]
+
+    def utilisation(self, length, choices, *prefixes):
+        '''Describe how much of the identifiers space of the day has been
+           leased by all the processes'''
+        day = str(date.today())
+        row = self.connection.execute('SELECT next FROM transaction_id_sequence '
+                                      'WHERE day = ? AND prefix = ?',
+                                      (day, '-'.join(prefixes))).fetchone()
+        leased = row[0] if row else 0
+        capacity = len(choices) ** length
+        return {
+            'day': day,
+            'leased': leased,
+            'capacity': capacity,
+            'remaining': capacity - leased,
+            'ratio': float(leased) / capacity,
+            'issued_by_process': self.issued,
+        }
+
+
+class MeteredAllocator(Allocator):
+    '''Report the allocations of allocator and their collisions to metrics.
+       The allocator is left untouched, it can be shared by payments
+       reporting to other collectors.'''
+
+    def __init__(self, allocator, metrics):
+        self.allocator = allocator
+        self.metrics = metrics
+        self.name = allocator.__class__.__name__
+        self.SEQUENTIAL = allocator.SEQUENTIAL
+        # collisions can only be seen when allocate() draws random
+        # identifiers and reserves them, as the base class does
+        self.draws = type(allocator).allocate.im_func \
+                is Allocator.allocate.im_func
+
+    def allocate(self, length, choices, *prefixes):
+        with self.metrics.timer('eopayment_transaction_id_seconds',
+                                allocator=self.name):
+            if self.draws:
+                return super(MeteredAllocator, self).allocate(length,
+                        choices, *prefixes)
+            return self.allocator.allocate(length, choices, *prefixes)
+
+    def reserve(self, id, *prefixes):
+        reserved = self.allocator.reserve(id, *prefixes)
+        if not reserved:
+            self.metrics.increment('eopayment_transaction_id_collisions_total',
+                                   allocator=self.name)
+        return reserved
+
+    def allocate_many(self, count, length, choices, *prefixes):
+        return self.allocator.allocate_many(count, length, choices, *prefixes)
+
+    def purge(self, retention, today=None):
+        return self.allocator.purge(retention, today)
+
+    def __getattr__(self, name):
+        # other methods of the allocator, like utilisation()
+        return getattr(self.allocator, name)
+
+
+ALLOCATORS = {
+    'file': FileAllocator,
+    'sharded_file': ShardedFileAllocator,
+    'memory': MemoryAllocator,
+    'sqlite': SQLiteAllocator,
+    'sequence': SequenceAllocator,
+}
+
+
+def get_allocator(options, path):
+    '''Build the allocator described by options, the allocator options are
+       removed from the dictionary. path is the default directory.'''
+    allocator = options.pop(ALLOCATOR, None) or 'file'
+    path = options.pop(ALLOCATOR_PATH, None) or path
+    if isinstance(allocator, Allocator):
+        return allocator
+    try:
+        factory = ALLOCATORS[allocator]
+    except KeyError:
+        raise ValueError('unknown transaction id allocator %r' % allocator)
+    return factory(path)
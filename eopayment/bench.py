@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+'''Benchmarks of the request and response paths of every backend
+
+    python -m eopayment.bench [--iterations N] [--backend KIND]...
+
+For each backend request() and response() are timed on a valid payment and a
+valid notification, the latency percentiles and the throughput are printed.
+The cost of each transaction id allocator is measured the same way. The SIPS
+backend uses the fake request and response executables shipped alongside
+this module. For SPPlus and SystemPay the encoding of the request URL is also
+timed alone, once with all the fields and once with the static fields
+encoded in advance, the name of those benchmarks gives the number of fields
+encoded by each call. The whole SystemPay request() is timed again with
+the static fields checked and encoded by each call, as when the configuration
+is not valid, in the request (full encoding) benchmark; SPPlus always encodes
+its static fields in advance.
+
+request() and response() are timed again with debug logging enabled, the
+messages are formatted and written to a stream discarding them, so the
+overhead of debug logging is the difference between the (debug) benchmarks
+and the others. --no-debug skips them.
+'''
+
+import logging
+import optparse
+import os.path
+import shutil
+import string
+import tempfile
+import time
+import urllib
+from collections import namedtuple
+from contextlib import contextmanager
+
+from eopayment import Payment, SPPLUS, SYSTEMPAY, DUMMY, SIPS
+from allocator import ALLOCATORS
+import spplus
+
+__all__ = ['Result', 'measure', 'run', 'BENCHMARKS']
+
+SPPLUS_KEY = '58 6d fc 9c 34 91 9b 86 3f fd 64 63 c9 13 4a 26 ba 29 74 1e ' \
+             'c7 e9 80 79'
+SYSTEMPAY_SECRET = '2662931409789978'
+SYSTEMPAY_RESPONSE = 'vads_amount=100&vads_auth_mode=FULL&vads_auth_number=767712&vads_auth_result=00&vads_capture_delay=0&vads_card_brand=CB&vads_card_number=497010XXXXXX0000&vads_payment_certificate=9da32cc109882089e1b3fb80888ebbef072f70b7&vads_ctx_mode=TEST&vads_currency=978&vads_effective_amount=100&vads_site_id=93413345&vads_trans_date=20120529132547&vads_trans_id=620594&vads_validation_mode=0&vads_version=V2&vads_warranty_result=NO&vads_payment_src=&vads_order_id=---&vads_cust_country=FR&vads_contrib=eopayment&vads_contract_used=2334233&vads_expiry_month=6&vads_expiry_year=2013&vads_pays_ip=FR&vads_identifier=&vads_subscription=&vads_threeds_enrolled=&vads_threeds_cavv=&vads_threeds_eci=&vads_threeds_xid=&vads_threeds_cavvAlgorithm=&vads_threeds_status=&vads_threeds_sign_valid=&vads_threeds_error_code=&vads_threeds_exit_status=&vads_result=00&vads_extra_result=&vads_card_country=FR&vads_language=fr&vads_action_mode=INTERACTIVE&vads_page_action=PAYMENT&vads_payment_config=SINGLE&signature=9c4f2bf905bb06b008b07090905adf36638d8ece&'
+BINPATH = os.path.dirname(os.path.abspath(__file__))
+
+
+class Result(namedtuple('Result', 'name iterations total p50 p90 p99 max')):
+    '''Timings of a benchmark, durations are in seconds'''
+
+    @property
+    def throughput(self):
+        return self.iterations / self.total if self.total else float('inf')
+
+    def __str__(self):
+        return '%-40s %8d %10.1f/s %9.1fus %9.1fus %9.1fus %9.1fus' % (
+                self.name, self.iterations, self.throughput,
+                self.p50 * 1e6, self.p90 * 1e6, self.p99 * 1e6,
+                self.max * 1e6)
+
+HEADER = '%-40s %8s %12s %11s %11s %11s %11s' % ('benchmark', 'calls',
+        'throughput', 'p50', 'p90', 'p99', 'max')
+
+
+def percentile(timings, ratio):
+    '''timings must be sorted'''
+    return timings[min(len(timings) - 1, int(len(timings) * ratio))]
+
+
+def measure(name, func, iterations):
+    '''Call func iterations times and return a Result'''
+    timings = []
+    clock = time.time
+    for i in xrange(iterations):
+        start = clock()
+        func()
+        timings.append(clock() - start)
+    timings.sort()
+    return Result(name, iterations, sum(timings), percentile(timings, 0.5),
+            percentile(timings, 0.9), percentile(timings, 0.99), timings[-1])
+
+
+def urlencode_benchmarks(static, dynamic):
+    '''Compare the encoding of all the fields of a request URL with the
+       encoding of its dynamic fields appended to a precomputed query'''
+    fields = dict(static)
+    fields.update(dynamic)
+    static_query = urllib.urlencode(static)
+    return [
+        ('urlencode full (%d fields)' % len(fields),
+            lambda: urllib.urlencode(fields)),
+        ('urlencode template (%d fields)' % len(dynamic),
+            lambda: '%s&%s' % (static_query, urllib.urlencode(dynamic))),
+    ]
+
+
+def spplus_benchmarks():
+    payment = Payment(SPPLUS, {'cle': SPPLUS_KEY,
+        'siret': '00000000000001-01', 'transaction_id_allocator': 'memory'})
+    query = 'reference=ZYX0NIFcbZIDuiZfazQp&etat=10&refsfp=1234'
+    query = '%s&hmac=%s' % (query, spplus.sign_ntkey_query(SPPLUS_KEY, query))
+    return [
+        ('request', lambda: payment.request('10.00', email='bob@example.com',
+            next_url='https://example.com/')),
+        ('response', lambda: payment.response(query)),
+    ] + urlencode_benchmarks(payment.backend.static_fields, {
+        'montant': '10.00', 'reference': 'ZYX0NIFcbZIDuiZfazQp',
+        'validite': '01/01/2013', 'email': 'bob@example.com',
+        'urlretour': 'https://example.com/'})
+
+
+def systempay_benchmarks():
+    def options():
+        return {'secret_test': SYSTEMPAY_SECRET, 'site_id': '93413345',
+                'ctx_mode': 'TEST', 'transaction_id_allocator': 'memory'}
+    payment = Payment(SYSTEMPAY, options())
+    # checks and encodes all the fields on each request
+    full = Payment(SYSTEMPAY, options())
+    full.backend.static_valid = False
+    def request(payment):
+        return lambda: payment.request(10, email='bob@example.com',
+                next_url='https://example.com/')
+    return [
+        ('request', request(payment)),
+        ('response', lambda: payment.response(SYSTEMPAY_RESPONSE)),
+        ('request (full encoding)', request(full)),
+    ] + urlencode_benchmarks(payment.backend.defaults, {
+        'vads_amount': '1000', 'vads_trans_id': '620594',
+        'vads_trans_date': '20120529132547',
+        'vads_cust_email': 'bob@example.com',
+        'vads_url_return': 'https://example.com/',
+        'signature': '9c4f2bf905bb06b008b07090905adf36638d8ece'})
+
+
+def dummy_benchmarks():
+    payment = Payment(DUMMY, {'siret': '1234', 'origin': 'bench',
+        'direct_notification_url': 'https://example.com/notification',
+        'transaction_id_allocator': 'memory'})
+    query = 'transaction_id=6Tfw2e1bPyYnz7CedZqvdHt7T9XX6T&ok=1&signed=1'
+    return [
+        ('request', lambda: payment.request('10.00', email='bob@example.com',
+            next_url='https://example.com/')),
+        ('response', lambda: payment.response(query)),
+    ]
+
+
+def sips_benchmarks():
+    payment = Payment(SIPS, {'binpath': BINPATH,
+        'transaction_id_allocator': 'memory'})
+    return [
+        ('request', lambda: payment.request('10.00', email='bob@example.com',
+            next_url='https://example.com/')),
+        ('response', lambda: payment.response('DATA=xxx')),
+    ]
+
+
+BENCHMARKS = {
+    SPPLUS: spplus_benchmarks,
+    SYSTEMPAY: systempay_benchmarks,
+    DUMMY: dummy_benchmarks,
+    SIPS: sips_benchmarks,
+}
+
+
+def allocator_benchmarks(path):
+    benchmarks = []
+    for name in sorted(ALLOCATORS):
+        allocator = ALLOCATORS[name](path)
+        benchmarks.append((name, lambda allocator=allocator:
+            allocator.allocate(20, string.letters, 'bench')))
+    return benchmarks
+
+
+class NullStream(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+@contextmanager
+def debug_logging():
+    '''Send the debug messages of eopayment to a stream discarding them'''
+    logger = logging.getLogger('eopayment')
+    handler = logging.StreamHandler(NullStream())
+    level, propagate = logger.level, logger.propagate
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    try:
+        yield
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = propagate
+
+
+def run(iterations=1000, kinds=None, debug=True):
+    '''Run the benchmarks of the given backends, all by default, and of the
+       allocators, return a list of Result. If debug, request() and
+       response() are also run with debug logging enabled.'''
+    results = []
+    kinds = kinds or sorted(BENCHMARKS)
+    for kind in kinds:
+        for name, func in BENCHMARKS[kind]():
+            results.append(measure('%s %s' % (kind, name), func, iterations))
+    if debug:
+        with debug_logging():
+            for kind in kinds:
+                for name, func in BENCHMARKS[kind]():
+                    if name in ('request', 'response'):
+                        results.append(measure('%s %s (debug)' % (kind, name),
+                                               func, iterations))
+    path = tempfile.mkdtemp()
+    try:
+        for name, func in allocator_benchmarks(path):
+            results.append(measure('allocator %s' % name, func, iterations))
+    finally:
+        shutil.rmtree(path)
+    return results
+
+
+def main(args=None):
+    parser = optparse.OptionParser(prog='python -m eopayment.bench')
+    parser.add_option('--iterations', type='int', default=1000,
+                      help='number of calls of each benchmark '
+                           '(default: %default)')
+    parser.add_option('--backend', action='append', dest='kinds',
+                      choices=sorted(BENCHMARKS.keys()),
+                      help='backend to benchmark, can be repeated '
+                           '(default: all)')
+    parser.add_option('--no-debug', action='store_false', dest='debug',
+                      default=True,
+                      help='do not time the backends with debug logging')
+    options, args = parser.parse_args(args)
+    print HEADER
+    for result in run(options.iterations, options.kinds, options.debug):
+        print result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+'''Cache of configured backends
+
+Building a backend has a cost (SPPlus decrypts its key, SystemPay rewrites
+its options, etc.), when a Payment is created for each HTTP request it is
+better to reuse backends already configured with the same options:
+
+    >>> cache = BackendCache(maxsize=512)
+    >>> payment = Payment(SPPLUS, spplus_options, cache=cache)
+
+Backends are keyed by their kind, their options and their logger, the least
+recently used backends are dropped when the cache is full. When the
+configuration of a merchant changes, its old backend can be dropped at once
+with cache.invalidate(kind, old_options).
+'''
+
+import threading
+from collections import OrderedDict
+
+from registry import get_backend
+
+__all__ = ['BackendCache', 'freeze']
+
+
+def freeze(value):
+    '''Convert options into a hashable value'''
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+class BackendCache(object):
+    '''Bounded LRU cache of configured backends, it is thread safe'''
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.backends = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def key(self, kind, options, logger):
+        return kind, freeze(options), logger
+
+    def get(self, kind, options, logger):
+        '''Return the backend for this configuration, build it if needed'''
+        key = self.key(kind, options, logger)
+        with self.lock:
+            backend = self.backends.pop(key, None)
+            if backend is not None:
+                self.backends[key] = backend
+                self.hits += 1
+                return backend
+            self.misses += 1
+        # backends consume their options, give them a copy
+        backend = get_backend(kind)(dict(options), logger=logger)
+        with self.lock:
+            self.backends[key] = backend
+            while len(self.backends) > self.maxsize:
+                self.backends.popitem(last=False)
+        return backend
+
+    def invalidate(self, kind=None, options=None, logger=None):
+        '''Drop the backend of a configuration, all the backends of a kind if
+           options is None, or all the backends if kind is None'''
+        with self.lock:
+            if kind is None:
+                self.backends.clear()
+            elif options is None:
+                for key in [k for k in self.backends if k[0] == kind]:
+                    del self.backends[key]
+            else:
+                frozen = freeze(options)
+                for key in [k for k in self.backends
+                            if k[:2] == (kind, frozen)
+                            and logger in (None, k[2])]:
+                    del self.backends[key]
+
+    def __len__(self):
+        return len(self.backends)
@@ -37,3 +37,19 @@ CB_RESPONSE_CODES = {
     '98': 'Serveur indisponible routage réseau demandé à nouveau',
     '99': 'Incident domaine initiateur',
 }
+
+
+def status_index(codes):
+    '''Map each code to its preformatted "code: message" status'''
+    return dict((code, '%s: %s' % (code, message))
+                for code, message in codes.iteritems())
+
+
+def status(index, code, unknown='Code inconnu'):
+    '''Return the status of code from an index built by status_index()'''
+    try:
+        return index[code]
+    except KeyError:
+        return '%s: %s' % (code, unknown)
+
+CB_RESPONSE_STATUS = status_index(CB_RESPONSE_CODES)
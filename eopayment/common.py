@@ -1,11 +1,15 @@
-import os.path
-import os
 import random
 import logging
-from datetime import date
+import urlparse
+from collections import namedtuple
+from itertools import islice, izip
+
+from allocator import MeteredAllocator, get_allocator
+from metrics import METRICS, NULL_METRICS
+from tracing import TRACER, stage
 
 __all__ = ['PaymentCommon', 'URL', 'HTML', 'RANDOM', 'RECEIVED', 'ACCEPTED',
-           'PAID', 'ERROR']
+           'PAID', 'ERROR', 'QueryField', 'parse_query', 'query_dict']
 
 
 LOGGER = logging.getLogger(__name__)
@@ -38,21 +42,67 @@ class PaymentResponse(object):
        transaction_id -- the id assigned by the bank to this transaction, it
        could be the one sent by the merchant in the request, but it is usually
        an identifier internal to the bank.
+
+       duplicate -- True when the response was returned from a
+       notification store because the same notification was already
+       processed.
+
+       Responses are immutable. bank_data and bank_status can be given as
+       functions without arguments, they are then only computed on first
+       access.
     '''
+    FIELDS = ('result', 'signed', 'bank_data', 'return_content',
+              'bank_status', 'transaction_id', 'order_id', 'duplicate')
+    __slots__ = ('result', 'signed', '_bank_data', 'return_content',
+                 '_bank_status', 'transaction_id', 'order_id', 'duplicate')
 
-    def __init__(self, result=None, signed=None, bank_data=dict(),
+    def __init__(self, result=None, signed=None, bank_data=None,
             return_content=None, bank_status='', transaction_id='',
-            order_id=''):
-        self.result = result
-        self.signed = signed
-        self.bank_data = bank_data
-        self.return_content = return_content
-        self.bank_status = bank_status
-        self.transaction_id = transaction_id
-        self.order_id = order_id
+            order_id='', duplicate=False):
+        init = object.__setattr__
+        init(self, 'result', result)
+        init(self, 'signed', signed)
+        init(self, '_bank_data', {} if bank_data is None else bank_data)
+        init(self, 'return_content', return_content)
+        init(self, '_bank_status', bank_status)
+        init(self, 'transaction_id', transaction_id)
+        init(self, 'order_id', order_id)
+        init(self, 'duplicate', duplicate)
+
+    def lazy(self, name):
+        value = getattr(self, name)
+        if callable(value):
+            value = value()
+            object.__setattr__(self, name, value)
+        return value
+
+    @property
+    def bank_data(self):
+        return self.lazy('_bank_data')
+
+    @property
+    def bank_status(self):
+        return self.lazy('_bank_status')
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def copy(self, **changes):
+        '''Return a copy of the response with some fields changed'''
+        values = dict((name, getattr(self, name)) for name in self.FIELDS)
+        values.update(changes)
+        return self.__class__(**values)
+
+    def __reduce__(self):
+        return (self.__class__,
+                tuple(getattr(self, name) for name in self.FIELDS))
 
     def __repr__(self):
-        return '<%s %s>' % (self.__class__.__name__, self.__dict__)
+        return '<%s %s>' % (self.__class__.__name__,
+                dict((name, getattr(self, name)) for name in self.FIELDS))
 
     def is_received(self):
         return self.result == RECEIVED
@@ -67,29 +117,140 @@ class PaymentResponse(object):
         return self.result == ERROR
 
 
+# a field of a query string, raw is the value as found in the query string
+# between the offsets start and end, value is the decoded value
+QueryField = namedtuple('QueryField', 'name raw value start end')
+
+
+def unquote(value):
+    if '%' in value or '+' in value:
+        # urllib.unquote_plus(), urllib is slow to import
+        return urlparse.unquote(value.replace('+', ' '))
+    return value
+
+
+def parse_query(query_string):
+    '''Lazily yield a QueryField for each field of query_string, in order.
+
+       Fields are separated by & only, a field without = has an empty value
+       and empty fields are skipped.
+    '''
+    find = query_string.find
+    length = len(query_string)
+    position = 0
+    while position < length:
+        end = find('&', position)
+        if end == -1:
+            end = length
+        if end > position:
+            equal = find('=', position, end)
+            if equal == -1:
+                name, start = query_string[position:end], end
+            else:
+                name, start = query_string[position:equal], equal + 1
+            raw = query_string[start:end]
+            yield QueryField(unquote(name), raw, unquote(raw), start, end)
+        position = end + 1
+
+
+def query_dict(fields, keep_blank_values=False):
+    '''Map names to decoded values, like parse_qs() the first value of a
+       field wins and blank values are dropped unless keep_blank_values'''
+    values = {}
+    for field in fields:
+        if field.name not in values and (field.value or keep_blank_values):
+            values[field.name] = field.value
+    return values
+
+
+def scan_fields(query_string, names):
+    '''Return the decoded values of the given fields of a query string'''
+    values = {}
+    for field in parse_query(query_string):
+        if field.name in names and field.name not in values:
+            values[field.name] = field.value
+    return values
+
+
 class PaymentCommon(object):
     PATH = '/tmp'
     BANK_ID = '__bank_id'
+    # name of the notification field identifying the merchant, see
+    # routing_key()
+    ROUTING_FIELD = None
+    # transaction ids only need to be unique during their day, they can be
+    # given by a sequential allocator
+    DAILY_TRANSACTION_ID = False
 
     def __init__(self, options, logger=LOGGER):
-        logger.debug('initializing with options %s' % options)
-        for key, value in self.description['parameters'].iteritems():
-            if 'default' in value:
-                setattr(self, key, options.get(key, None) or value['default'])
+        logger.debug('initializing with options %s', options)
+        self.setup(options)
+        for parameter in self.description['parameters']:
+            key = parameter['name']
+            if 'default' in parameter:
+                setattr(self, key,
+                        options.get(key, None) or parameter['default'])
             else:
                 setattr(self, key, options.get(key))
 
+    def setup(self, options):
+        '''Build the transaction id allocator, the metrics collector and
+           the tracer, their options are removed from the dictionary'''
+        self.allocator = get_allocator(options, self.PATH)
+        if self.allocator.SEQUENTIAL and not self.DAILY_TRANSACTION_ID:
+            raise ValueError('the %s allocator restarts every day, it cannot '
+                             'give transaction ids which must stay unique'
+                             % self.allocator.__class__.__name__)
+        self.metrics = options.pop(METRICS, None) or NULL_METRICS
+        self.tracer = options.pop(TRACER, None)
+        if self.metrics is not NULL_METRICS:
+            self.allocator = MeteredAllocator(self.allocator, self.metrics)
+
     def transaction_id(self, length, choices, *prefixes):
+        '''Reserve a new transaction id using the configured allocator'''
+        with stage(self.tracer, 'transaction_id'):
+            return self.allocator.allocate(length, choices, *prefixes)
+
+    def transaction_id_args(self):
+        '''Arguments of transaction_id() for the payments of this merchant:
+           length, choices and prefixes'''
+        raise NotImplementedError
+
+    def request_many(self, items, chunksize=100):
+        '''Lazily yield the result of request() for an iterable of
+           (amount, email, next_url[, extra]) tuples, transaction ids are
+           allocated chunksize at a time.'''
+        args = self.transaction_id_args()
+        items = iter(items)
         while True:
-            parts = [RANDOM.choice(choices) for x in range(length)]
-            id = ''.join(parts)
-            name = '%s_%s_%s' % (str(date.today()),
-                                 '-'.join(prefixes), str(id))
-            try:
-                fd = os.open(os.path.join(self.PATH, name),
-                             os.O_CREAT | os.O_EXCL)
-            except:
-                raise
-            else:
-                os.close(fd)
-                return id
+            batch = list(islice(items, chunksize))
+            if not batch:
+                break
+            ids = self.allocator.allocate_many(len(batch), *args)
+            for item, transaction_id in izip(batch, ids):
+                yield self.request_item(item, transaction_id)
+
+    def request_item(self, item, transaction_id):
+        '''Call request() for an (amount, email, next_url[, extra]) tuple,
+           extra is a dictionary of backend specific arguments'''
+        amount, email, next_url = item[:3]
+        extra = item[3] if len(item) > 3 else None
+        return self.request(amount, email=email, next_url=next_url,
+                transaction_id=transaction_id, **(extra or {}))
+
+    def routing_key(self):
+        '''Value of ROUTING_FIELD in the notifications sent to this
+           merchant'''
+        return None
+
+    def notification_key(self, query_string):
+        '''Return a tuple identifying the event notified by query_string,
+           notifications of the same event must give the same key. None
+           means notifications cannot be identified without verifying them.
+        '''
+        return None
+
+    def response_many(self, query_strings):
+        '''Lazily yield the responses to an iterable of query strings'''
+        for query_string in query_strings:
+            yield self.response(query_string)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+'''Non blocking interface to the payment backends
+
+AsyncPayment has the same interface as eopayment.Payment but request() and
+response() return at once a future of their result, the work is done by a
+pool of threads. For SIPS the executables run outside the interpreter lock
+and for SystemPay and SPPlus signing happen outside of the caller thread, so
+an event loop can keep serving other clients in the meantime.
+
+    >>> payment = AsyncPayment(SPPLUS, spplus_options)
+    >>> future = payment.request('10.00', email='bob@example.com')
+    >>> future.add_done_callback(lambda f: redirect(f.result()[2]))
+
+When the concurrent.futures module (or its backport) is available, futures
+are standard concurrent.futures.Future objects, so they can be adapted for
+Tornado or Twisted with the usual wrappers. Waiting for a result longer than
+the given timeout raises TimeoutError, concurrent.futures.TimeoutError when
+that module is available.
+'''
+
+import logging
+import sys
+import threading
+import Queue
+
+try:
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError
+except ImportError:
+    ThreadPoolExecutor = None
+
+    class TimeoutError(Exception):
+        '''The result of a future was not available in time'''
+
+from eopayment import Payment
+
+__all__ = ['AsyncPayment', 'Future', 'Executor', 'TimeoutError']
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Future(object):
+    '''Minimal future, a subset of concurrent.futures.Future'''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.value = None
+        self.exc_info = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout):
+        if not self.event.wait(timeout) and not self.done():
+            raise TimeoutError()
+
+    def result(self, timeout=None):
+        self.wait(timeout)
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def exception(self, timeout=None):
+        self.wait(timeout)
+        return self.exc_info and self.exc_info[1]
+
+    def add_done_callback(self, fn):
+        with self.lock:
+            if not self.done():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, value, exc_info=None):
+        with self.lock:
+            self.value = value
+            self.exc_info = exc_info
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                LOGGER.exception('future callback %r failed', callback)
+
+
+class Executor(object):
+    '''Minimal thread pool, used when concurrent.futures is missing'''
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception:
+                future.set_result(None, sys.exc_info())
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            if len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self.worker)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for thread in threads:
+            self.queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+class AsyncPayment(object):
+    '''Wrap a Payment so that request() and response() return futures.
+
+       executor -- an object with a submit() method like
+       concurrent.futures.ThreadPoolExecutor, by default a pool of
+       max_workers threads is created.
+    '''
+
+    def __init__(self, kind, options, logger=LOGGER, executor=None,
+            max_workers=8):
+        self.payment = Payment(kind, options, logger=logger)
+        self.kind = kind
+        if executor is None:
+            if ThreadPoolExecutor is not None:
+                executor = ThreadPoolExecutor(max_workers)
+            else:
+                executor = Executor(max_workers)
+        self.executor = executor
+
+    def request(self, amount, email=None, next_url=None):
+        '''Return a future of Payment.request()'''
+        return self.executor.submit(self.payment.request, amount,
+                email=email, next_url=next_url)
+
+    def response(self, query_string):
+        '''Return a future of Payment.response()'''
+        return self.executor.submit(self.payment.response, query_string)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
@@ -7,7 +7,9 @@ try:
 except ImportError:
     from urlparse import parse_qs
 
-from common import PaymentCommon, URL, PaymentResponse, PAID, ERROR
+from common import (PaymentCommon, URL, PaymentResponse, PAID, ERROR,
+        scan_fields)
+from tracing import stage
 
 __all__ = [ 'Payment' ]
 
@@ -71,8 +73,24 @@ class Payment(PaymentCommon):
             ],
     }
 
-    def request(self, montant, email=None, next_url=None, logger=LOGGER):
-        transaction_id = self.transaction_id(30, ALPHANUM, 'dummy', self.siret)
+    ROUTING_FIELD = 'siret'
+
+    def routing_key(self):
+        return self.siret
+
+    def notification_key(self, query_string):
+        values = scan_fields(query_string, ('transaction_id', 'ok'))
+        if 'transaction_id' not in values:
+            return None
+        return (values['transaction_id'], 'ok' in values)
+
+    def transaction_id_args(self):
+        return (30, ALPHANUM, 'dummy', self.siret)
+
+    def request(self, montant, email=None, next_url=None, logger=LOGGER,
+            transaction_id=None):
+        transaction_id = transaction_id or \
+                self.transaction_id(*self.transaction_id_args())
         if self.next_url:
             next_url = self.next_url
         query = {
@@ -84,11 +102,13 @@ class Payment(PaymentCommon):
                 'direct_notification_url': self.direct_notification_url,
                 'origin': self.origin
         }
-        url = '%s?%s' % (SERVICE_URL, urllib.urlencode(query))
+        with stage(self.tracer, 'urlencode'):
+            url = '%s?%s' % (SERVICE_URL, urllib.urlencode(query))
         return transaction_id, URL, url
 
     def response(self, query_string, logger=LOGGER):
-        form = parse_qs(query_string)
+        with stage(self.tracer, 'parse_qs'):
+            form = parse_qs(query_string)
         transaction_id = form.get('transaction_id',[''])[0]
         form[self.BANK_ID] = transaction_id
 
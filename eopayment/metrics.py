@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+'''Metrics of the payment operations
+
+A Payment created with a metrics collector reports the duration of its
+request() and response() calls and of the steps of the backends, and counts
+errors, signature failures and transaction id collisions:
+
+    >>> metrics = MemoryMetrics()
+    >>> payment = Payment(SYSTEMPAY, options, metrics=metrics)
+    >>> ...
+    >>> print metrics.render()
+    # TYPE eopayment_request_seconds histogram
+    eopayment_request_seconds_bucket{backend="systempayv2",le="0.0001"} 0
+    ...
+
+MemoryMetrics keeps the values in the current process and renders them in
+the Prometheus text format, to be served by the application. When the
+prometheus_client module is installed, PrometheusMetrics registers them in
+its registry instead. Other exporters subclass Metrics and implement
+increment() and observe(); the default collector does nothing.
+
+The metrics are:
+
+ - eopayment_request_seconds, eopayment_response_seconds, duration of the
+   Payment calls by backend,
+ - eopayment_errors_total, exceptions raised by the Payment calls by backend
+   and operation,
+ - eopayment_responses_total, responses by backend and signed flag,
+ - eopayment_signature_failures_total, notifications whose signature does
+   not verify, by backend,
+ - eopayment_transaction_id_seconds and
+   eopayment_transaction_id_collisions_total, allocation of transaction ids,
+ - eopayment_validation_seconds, eopayment_signing_seconds and
+   eopayment_parse_seconds, steps of the backends,
+ - eopayment_subprocess_seconds and eopayment_subprocess_failures_total,
+   executions of the SIPS executables.
+'''
+
+import threading
+import time
+
+__all__ = ['Metrics', 'MemoryMetrics', 'PrometheusMetrics', 'NULL_METRICS',
+           'BUCKETS']
+
+METRICS = 'metrics'
+
+# operations of the backends last from microseconds to seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Timer(object):
+    '''Context manager observing the duration of its block'''
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.time() - self.start,
+                             **self.labels)
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics(object):
+    '''Collector which drops everything, base class of the collectors'''
+
+    def increment(self, name, value=1, **labels):
+        '''Add value to the counter name'''
+        pass
+
+    def observe(self, name, value, **labels):
+        '''Add value to the histogram name'''
+        pass
+
+    def timer(self, name, **labels):
+        '''Return a context manager observing its duration in name'''
+        return NULL_TIMER
+
+NULL_METRICS = Metrics()
+
+
+def label_key(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\',
+        '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+class MemoryMetrics(Metrics):
+    '''Keep counters and histograms in memory and render them in the
+       Prometheus text exposition format'''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # counts by bucket, then sum and count
+                histogram = self.histograms[key] = \
+                        [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def counter(self, name, **labels):
+        '''Return the value of a counter'''
+        return self.counters.get((name, label_key(labels)), 0)
+
+    def count(self, name, **labels):
+        '''Return the number of values observed by a histogram'''
+        histogram = self.histograms.get((name, label_key(labels)))
+        return histogram[-1] if histogram else 0
+
+    def render(self):
+        '''Return the metrics in the Prometheus text format'''
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value))
+                                for key, value in self.histograms.items())
+        lines = []
+        last = None
+        for (name, labels), value in counters:
+            if name != last:
+                lines.append('# TYPE %s counter' % name)
+                last = name
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name != last:
+                lines.append('# TYPE %s histogram' % name)
+                last = name
+            for bound, count in zip(self.buckets, histogram):
+                lines.append('%s_bucket%s %d' % (name,
+                    format_labels(labels + (('le', repr(bound)),)), count))
+            lines.append('%s_bucket%s %d' % (name,
+                format_labels(labels + (('le', '+Inf'),)), histogram[-1]))
+            lines.append('%s_sum%s %r' % (name, format_labels(labels),
+                                          histogram[-2]))
+            lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                            histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+class PrometheusMetrics(Metrics):
+    '''Register the metrics in a prometheus_client registry, the default
+       one if registry is None'''
+
+    def __init__(self, registry=None, buckets=BUCKETS):
+        # only imported when used, import eopayment must stay cheap
+        try:
+            import prometheus_client
+        except ImportError:
+            raise RuntimeError('prometheus_client is not installed')
+        self.client = prometheus_client
+        self.registry = registry or prometheus_client.REGISTRY
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def metric(self, factory, name, labels, **kwargs):
+        # prometheus_client needs the label names of a metric when it is
+        # created
+        key = (name, tuple(sorted(labels)))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = factory(name, name,
+                            sorted(labels), registry=self.registry, **kwargs)
+        return metric.labels(**labels) if labels else metric
+
+    def increment(self, name, value=1, **labels):
+        if name.endswith('_total'):
+            name = name[:-len('_total')]
+        self.metric(self.client.Counter, name, labels).inc(value)
+
+    def observe(self, name, value, **labels):
+        self.metric(self.client.Histogram, name, labels,
+                    buckets=self.buckets).observe(value)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
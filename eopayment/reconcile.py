@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+'''Reconciliation of stored notifications with the issued transaction ids
+
+    >>> issued = set(line.strip() for line in open('issued-ids.txt'))
+    >>> reconciliation = Reconciliation(payment, issued)
+    >>> for entry in reconciliation.run(open('notifications.log')):
+    ...     if entry.status != PAID:
+    ...         print entry.status, entry.order_id
+    >>> print reconciliation.counts
+
+Notifications logs contain one notification by line, either the raw query
+string or a JSON object with a query_string key. payment is an
+eopayment.Payment or anything with a response() method, like a
+eopayment.router.PaymentRouter. Lines are read and parsed one at a time, the
+state kept is the set of distinct notifications of issued ids and the set of
+paid ids. Duplicates and notifications of unknown ids add nothing, so memory
+is bounded by the number of issued ids and their distinct results, not by
+the size of the log.
+
+The statuses reported are:
+
+ - paid, the first paid notification of an issued id,
+ - unpaid, the first notification of another result for an issued id,
+ - duplicate, a notification already seen,
+ - invalid_signature, a notification whose signature does not verify,
+ - unknown, a signed notification for an id which was not issued,
+ - malformed, a line which cannot be parsed,
+ - missing, reported at the end for each issued id without paid
+   notification.
+'''
+
+import json
+from collections import namedtuple
+from itertools import chain
+
+__all__ = ['Reconciliation', 'Entry', 'read_log', 'PAID', 'UNPAID',
+           'DUPLICATE', 'INVALID_SIGNATURE', 'UNKNOWN', 'MALFORMED', 'MISSING']
+
+PAID = 'paid'
+UNPAID = 'unpaid'
+DUPLICATE = 'duplicate'
+INVALID_SIGNATURE = 'invalid_signature'
+UNKNOWN = 'unknown'
+MALFORMED = 'malformed'
+MISSING = 'missing'
+STATUSES = (PAID, UNPAID, DUPLICATE, INVALID_SIGNATURE, UNKNOWN, MALFORMED,
+            MISSING)
+
+Entry = namedtuple('Entry', 'status order_id response line')
+
+
+def log_lines(lines):
+    '''Yield the non empty lines of a notifications log'''
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def parse_line(line):
+    '''Return the query string of a line of a notifications log, raise
+       ValueError if the line is malformed'''
+    if not line.startswith('{'):
+        return line
+    query_string = json.loads(line).get('query_string')
+    if not isinstance(query_string, basestring):
+        raise ValueError('no query_string in %r' % line)
+    return query_string.encode('utf-8')
+
+
+def read_log(lines):
+    '''Yield the query strings of a notifications log'''
+    for line in log_lines(lines):
+        yield parse_line(line)
+
+
+class Reconciliation(object):
+    def __init__(self, payment, issued):
+        self.payment = payment
+        self.issued = issued
+        self.seen = set()
+        self.paid = set()
+        self.counts = dict.fromkeys(STATUSES, 0)
+
+    def classify(self, response):
+        if not response.signed:
+            return INVALID_SIGNATURE
+        order_id = response.order_id
+        if order_id not in self.issued:
+            return UNKNOWN
+        key = (order_id, response.result, response.transaction_id)
+        if key in self.seen:
+            return DUPLICATE
+        self.seen.add(key)
+        if response.is_paid():
+            self.paid.add(order_id)
+            return PAID
+        return UNPAID
+
+    def entry(self, status, order_id, response=None, line=None):
+        self.counts[status] += 1
+        return Entry(status, order_id, response, line)
+
+    def feed(self, lines):
+        '''Yield an Entry for each notification of the log'''
+        for line in log_lines(lines):
+            try:
+                query_string = parse_line(line)
+                response = self.payment.response(query_string)
+            except (ValueError, KeyError, IndexError):
+                yield self.entry(MALFORMED, None, line=line)
+                continue
+            yield self.entry(self.classify(response), response.order_id,
+                    response, query_string)
+
+    def missing(self):
+        '''Yield an Entry for each issued id without paid notification'''
+        for order_id in self.issued:
+            if order_id not in self.paid:
+                yield self.entry(MISSING, order_id)
+
+    def run(self, lines):
+        return chain(self.feed(lines), self.missing())
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+'''Resolution of backend names into backend classes
+
+Backend modules are only imported when a backend is first used. Their
+caption and the names of their parameters are also kept here, so that a
+list of the backends can be presented without importing any of them; the
+full description is the description attribute of the backend class.
+'''
+
+__all__ = ['get_backend', 'get_metadata', 'METADATA']
+
+# backend classes already resolved, by name
+BACKENDS = {}
+
+METADATA = {
+    'dummy': {
+        'caption': 'Dummy payment backend',
+        'parameters': ('dummy_service_url', 'direct_notification_url',
+                       'origin', 'siret', 'next_url',
+                       'consider_all_response_signed'),
+    },
+    'sips': {
+        'caption': 'SIPS',
+        'parameters': ('merchand_id', 'merchant_country', 'currency_code'),
+    },
+    'spplus': {
+        'caption': "SPPlus payment service of French bank Caisse d'epargne",
+        'parameters': ('cle', 'siret', 'langue', 'taxe', 'modalite', 'moyen'),
+    },
+    'systempayv2': {
+        'caption': 'SystemPay, système de paiment du groupe BPCE',
+        'parameters': ('service_url', 'secret_test', 'secret_production',
+                       'vads_ctx_mode', 'vads_site_id', 'vads_order_info',
+                       'vads_order_info2', 'vads_order_info3',
+                       'vads_payment_cards', 'vads_payment_config'),
+    },
+}
+
+
+def get_backend(kind):
+    '''Resolve a backend name into its Payment class, the backend module is
+       only imported the first time'''
+    try:
+        return BACKENDS[kind]
+    except KeyError:
+        module = __import__(kind, globals(), locals(), [])
+        BACKENDS[kind] = module.Payment
+        return module.Payment
+
+
+def get_metadata(kind):
+    '''Return the caption and the parameter names of a backend without
+       importing it'''
+    try:
+        return METADATA[kind]
+    except KeyError:
+        raise ValueError('unknown backend %r' % kind)
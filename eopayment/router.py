@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+'''Dispatch of bank notifications among many configured merchants
+
+    >>> router = PaymentRouter()
+    >>> for options in systempay_sites:
+    ...     router.add(Payment(SYSTEMPAY, options))
+    >>> payment = router.route(query_string)
+    >>> response = router.response(query_string)
+
+Each backend declares the notification field identifying the merchant
+(ROUTING_FIELD) and its value for its configuration (routing_key()):
+vads_site_id for SystemPay, siret for SPPlus and the dummy backend. The
+router indexes payments on their kind and those pairs, and finds the owner of
+a notification by scanning its query string until it meets one of the routing
+fields, only this value is decoded. When payments of several kinds share a
+routing value, the owner is the one whose backend identifies the
+notification (notification_key()).
+
+SIPS notifications are encrypted, the merchant_id is only known once the
+DATA field is decoded by the response executable, and merchants can have
+their own pathfile and certificate. The router tries the SIPS payments in
+the order they were added until one decodes the notification into one of
+the registered SIPS merchants, the response is then given by the payment of
+this merchant. Those trials are not restarted when the executable fails and
+are not reported by the payments which do not own the notification.
+'''
+
+from common import parse_query
+from sips import DATA, MERCHANT_ID
+
+__all__ = ['PaymentRouter']
+
+
+class PaymentRouter(object):
+    def __init__(self, payments=()):
+        self.index = {}
+        # kinds of the payments routed on each field
+        self.kinds = {}
+        self.sips = []
+        for payment in payments:
+            self.add(payment)
+
+    def routing(self, payment):
+        backend = payment.backend
+        return payment.kind, backend.ROUTING_FIELD, backend.routing_key()
+
+    def add(self, payment):
+        '''Register a Payment, its routing key must not be taken by another
+           payment of the same kind'''
+        key = self.routing(payment)
+        if key[1] is None:
+            raise ValueError('backend %s does not support routing'
+                             % payment.kind)
+        if key in self.index:
+            raise ValueError('%s %s=%s is already routed' % key)
+        self.index[key] = payment
+        if key[1] == MERCHANT_ID:
+            self.sips.append(payment)
+        else:
+            kinds = self.kinds.setdefault(key[1], [])
+            if payment.kind not in kinds:
+                kinds.append(payment.kind)
+
+    def remove(self, payment):
+        key = self.routing(payment)
+        if self.index.get(key) is payment:
+            del self.index[key]
+            if payment in self.sips:
+                self.sips.remove(payment)
+
+    def decode_sips(self, query_string):
+        '''Return the SIPS payment owning the notification and its response,
+           or (None, None)'''
+        for payment in list(self.sips):
+            try:
+                response = payment.backend.probe(query_string)
+            except (ValueError, RuntimeError):
+                # not decodable with the certificate of this merchant
+                continue
+            merchant_id = response.bank_data.get(MERCHANT_ID)
+            owner = self.index.get((payment.kind, MERCHANT_ID, merchant_id))
+            if owner is None:
+                continue
+            if owner is not payment:
+                # decoded again with the kit of its merchant
+                return owner, None
+            return owner, response
+        return None, None
+
+    def lookup(self, query_string, name, value):
+        '''Return the payment routed on name=value owning the notification,
+           or None'''
+        index = self.index
+        candidates = [index[key] for key in ((kind, name, value)
+                      for kind in self.kinds[name]) if key in index]
+        if len(candidates) > 1:
+            candidates = [payment for payment in candidates if
+                    payment.backend.notification_key(query_string) is not None]
+        if len(candidates) == 1:
+            return candidates[0]
+        return None
+
+    def find(self, query_string):
+        '''Return the Payment owning the notification and, for SIPS, its
+           decoded response'''
+        kinds = self.kinds
+        for field in parse_query(query_string):
+            name = field.name
+            if name in kinds:
+                return self.lookup(query_string, name, field.value), None
+            if name == DATA and self.sips:
+                return self.decode_sips(query_string)
+        return None, None
+
+    def route(self, query_string):
+        '''Return the Payment owning the notification, or None. SIPS
+           notifications are decoded to find their merchant.'''
+        return self.find(query_string)[0]
+
+    def response(self, query_string):
+        '''Route the notification and return the response of its owner,
+           raise ValueError if no registered payment owns it.'''
+        payment, response = self.find(query_string)
+        if payment is None:
+            raise ValueError('no payment for notification %r' % query_string)
+        if response is None:
+            return payment.response(query_string)
+        return payment.accept(query_string, response)
+
+    def __len__(self):
+        return len(self.index)
@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
-import urlparse
+import copy
 import string
 import subprocess
 from decimal import Decimal
 import logging
 import os
 import os.path
+import hashlib
+import random
+import threading
+import time
 import uuid
+from collections import namedtuple
 
-from common import PaymentCommon, HTML, PaymentResponse
+from common import (PaymentCommon, HTML, PaymentResponse, scan_fields,
+        parse_query, query_dict, PAID, ERROR)
 from cb import CB_RESPONSE_CODES
+from tracing import stage
 
 '''
 Payment backend module for the ATOS/SIPS system used by many Frenck banks.
@@ -23,12 +30,40 @@ The necessary options are:
  - binpath, the path of the directory containing the request and response
    executables,
 
+The executables are run directly, without a shell, each parameter is given
+as one key=value argument. The executables paths are resolved once when the
+payment is created, so that a payment can be used for any number of calls.
+
+The executables are run through a pool bounding the number of concurrent
+processes, it is configured with the optional options:
+
+ - max_workers, the maximum number of executables running at the same time
+   (default 8), excess calls wait for a free slot,
+ - timeout, the number of seconds after which an executable is killed
+   (default 30),
+ - retries, how many times a failed or killed execution is restarted
+   (default 1).
+
 All the other needed parameters SHOULD already be set in the parmcom files
 contained in the middleware distribution file.
 
+The DATA field of notifications is decoded by a decoder, given by the
+optional decoder option, by default the response executable is run. The
+ATOS message format is not documented, when a merchant kit allows to decode
+it in process, wrap the decoding function with a FunctionDecoder. To check it
+against the executable before using it, a ShadowDecoder runs both on a sample
+of the notifications, logs the mismatches and keeps the statistics, the
+response of the executable is the one returned:
+
+    >>> shadow = ShadowDecoder(FunctionDecoder(kit.decode), sample_rate=0.1)
+    >>> payment = Payment(SIPS, dict(options, decoder=shadow))
+    >>> ...
+    >>> print shadow.report()
+
 '''
 
-__all__ = ['Payment']
+__all__ = ['Payment', 'Decoder', 'BinaryDecoder', 'FunctionDecoder',
+           'ShadowDecoder']
 
 BINPATH = 'binpath'
 PATHFILE = 'pathfile'
@@ -51,8 +86,16 @@ RESPONSE_PARAMS = ['code', 'error', 'merchant_id', 'merchant_country',
     'customer_email', 'customer_ip_address', 'capture_day', 'capture_mode',
     'data', ]
 
+# outputs of the executables, fields are separated by !
+RequestResult = namedtuple('RequestResult', 'code error form')
+ResponseResult = namedtuple('ResponseResult', RESPONSE_PARAMS)
+
 DATA = 'DATA'
 PARAMS = 'params'
+DECODER = 'decoder'
+MAX_WORKERS = 'max_workers'
+TIMEOUT = 'timeout'
+RETRIES = 'retries'
 
 TRANSACTION_ID = 'transaction_id'
 ORDER_ID = 'order_id'
@@ -90,6 +133,202 @@ FINAREF_BANK_RESPONSE_CODE = {
 }
 
 
+class ExecutionPool(object):
+    '''Run executables with a bounded concurrency, kill them when they do
+       not finish in time and restart them when they fail.'''
+
+    def __init__(self, max_workers=8, timeout=30, retries=1, logger=LOGGER):
+        self.semaphore = threading.BoundedSemaphore(max_workers)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.logger = logger
+
+    def kill(self, process, lock):
+        '''Kill process unless it is already reaped, its pid may then
+           belong to another process'''
+        with lock:
+            if process.poll() is None:
+                process.kill()
+
+    def run_once(self, args, **kwargs):
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, **kwargs)
+        # the process is only reaped and killed under this lock
+        lock = threading.Lock()
+        timer = threading.Timer(self.timeout, self.kill, (process, lock))
+        timer.start()
+        try:
+            output = process.stdout.read()
+            process.stdout.close()
+            # the process usually exits with its output, it is killed by
+            # the timer if it lingers
+            delay = 0.0001
+            while True:
+                with lock:
+                    if process.poll() is not None:
+                        break
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        finally:
+            timer.cancel()
+        if process.returncode < 0:
+            raise RuntimeError('%s killed by signal %s' % (args,
+                -process.returncode))
+        if not output:
+            raise RuntimeError('%s returned nothing' % (args,))
+        return output
+
+    def without_retries(self):
+        '''Return a pool sharing the slots of this one which does not
+           restart failed executions'''
+        pool = copy.copy(self)
+        pool.retries = 0
+        return pool
+
+    def run(self, args, **kwargs):
+        '''Execute args, as subprocess.Popen would, and return its output'''
+        for attempt in range(self.retries + 1):
+            self.semaphore.acquire()
+            try:
+                return self.run_once(args, **kwargs)
+            except (RuntimeError, OSError), e:
+                self.logger.warning('execution failed (attempt %d): %s',
+                        attempt + 1, e)
+                error = e
+            finally:
+                self.semaphore.release()
+        raise error
+
+
+def parse_output(output, record):
+    '''Split the output of an executable into a record, the last field
+       keeps any remaining separator and missing fields are None'''
+    if output[:1] == '!':
+        output = output[1:]
+    if output[-1:] == '!':
+        output = output[:-1]
+    if not output:
+        raise ValueError('Invalid response', output)
+    size = len(record._fields)
+    values = output.split('!', size - 1)
+    if len(values) < size:
+        values.extend([None] * (size - len(values)))
+    return record._make(values)
+
+
+class Decoder(object):
+    '''Base class of the decoders of the DATA field of notifications'''
+
+    def decode(self, payment, data):
+        '''Return the ResponseResult of data for payment, raise ValueError
+           if data cannot be decoded'''
+        raise NotImplementedError
+
+
+class BinaryDecoder(Decoder):
+    '''Decode with the response executable of the merchant kit'''
+
+    def decode(self, payment, data):
+        return payment.execute('response', {'message': data}, ResponseResult)
+
+
+class FunctionDecoder(Decoder):
+    '''Decode in process with func, a function taking the DATA field and
+       returning the sequence of the RESPONSE_PARAMS values or a dictionary
+       of them'''
+
+    def __init__(self, func):
+        self.func = func
+
+    def decode(self, payment, data):
+        values = self.func(data)
+        if isinstance(values, dict):
+            return ResponseResult._make([values.get(name)
+                                         for name in RESPONSE_PARAMS])
+        values = list(values)
+        values.extend([None] * (len(RESPONSE_PARAMS) - len(values)))
+        return ResponseResult._make(values)
+
+
+class ShadowDecoder(Decoder):
+    '''Decode with primary, and on a sample_rate share of the messages also
+       with candidate, compare their results and their durations. The result
+       of primary is always returned, failures of candidate are only
+       counted.'''
+
+    def __init__(self, candidate, sample_rate=1.0, primary=None,
+            logger=LOGGER):
+        self.candidate = candidate
+        self.sample_rate = sample_rate
+        self.primary = primary or BinaryDecoder()
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.sampled = 0
+        self.mismatches = 0
+        self.errors = 0
+        self.primary_time = 0.0
+        self.candidate_time = 0.0
+
+    def decode(self, payment, data):
+        if random.random() >= self.sample_rate:
+            return self.primary.decode(payment, data)
+        start = time.time()
+        result = self.primary.decode(payment, data)
+        primary_time = time.time() - start
+        start = time.time()
+        try:
+            candidate = self.candidate.decode(payment, data)
+        except Exception:
+            self.logger.exception('shadow decoder failed on %r', data)
+            candidate, error = None, True
+        else:
+            error = False
+        candidate_time = time.time() - start
+        if candidate is not None and candidate != result:
+            self.logger.warning('shadow decoder mismatch on fields %s',
+                    ', '.join(name for name, a, b in
+                              zip(RESPONSE_PARAMS, result, candidate)
+                              if a != b))
+        with self.lock:
+            self.sampled += 1
+            self.errors += error
+            self.mismatches += candidate is not None and candidate != result
+            self.primary_time += primary_time
+            self.candidate_time += candidate_time
+        return result
+
+    def report(self):
+        '''Return the statistics of the sampled messages, durations are in
+           seconds'''
+        with self.lock:
+            sampled = self.sampled
+            return {
+                'sampled': sampled,
+                'mismatches': self.mismatches,
+                'errors': self.errors,
+                'primary_time': self.primary_time,
+                'candidate_time': self.candidate_time,
+                'mean_delta': (self.candidate_time - self.primary_time)
+                              / sampled if sampled else 0.0,
+            }
+
+
+BINARY_DECODER = BinaryDecoder()
+
+
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+def get_pool(max_workers=8, timeout=30, retries=1):
+    '''Return the pool shared by all the payments with the same settings'''
+    key = (int(max_workers), float(timeout), int(retries))
+    with POOLS_LOCK:
+        if key not in POOLS:
+            POOLS[key] = ExecutionPool(*key)
+        return POOLS[key]
+
+
 class Payment(PaymentCommon):
     description = {
             'caption': 'SIPS',
@@ -102,39 +341,82 @@ class Payment(PaymentCommon):
     }
 
     def __init__(self, options, logger=LOGGER):
+        self.setup(options)
+        pool_options = {}
+        for name in (MAX_WORKERS, TIMEOUT, RETRIES):
+            if name in options:
+                pool_options[name] = options.pop(name)
+        self.pool = get_pool(**pool_options)
+        self.decoder = options.pop(DECODER, None) or BINARY_DECODER
+        binpath = options.pop(BINPATH, '')
+        self.executables = {}
+        for name in ('request', 'response'):
+            path = os.path.join(binpath, name)
+            if os.path.dirname(path):
+                path = os.path.abspath(path)
+            self.executables[name] = path
         self.options = options
         self.logger = logger
-        self.logger.debug('initializing sips payment class with %s' % options)
+        self.logger.debug('initializing sips payment class with %s', options)
 
-    def execute(self, executable, params):
+    def execute(self, executable, params, record):
+        '''Run executable with params and parse its output as record'''
         if PATHFILE in self.options:
             params[PATHFILE] = self.options[PATHFILE]
-        executable = os.path.join(self.options.pop(BINPATH), executable)
-        args = [executable] + ["%s=%s" % p for p in params.iteritems()]
-        self.logger.debug('executing %s' % args)
-        result,_ = subprocess.Popen(' '.join(args),
-                stdout=subprocess.PIPE, shell=True).communicate()
+        args = [self.executables[executable]]
+        args.extend(['%s=%s' % p for p in params.iteritems()])
+        self.logger.debug('executing %s', args)
         try:
-            if result[0] == '!':
-                result = result[1:]
-            if result[-1] == '!':
-                result = result[:-1]
-        except IndexError:
-            raise ValueError("Invalid response", result)
-            return False
-        result = result.split('!')
-        self.logger.debug('got response %s' % result)
+            with self.metrics.timer('eopayment_subprocess_seconds',
+                                    executable=executable), \
+                    stage(self.tracer, 'execute', executable=executable):
+                output = self.pool.run(args)
+        except (RuntimeError, OSError), e:
+            self.metrics.increment('eopayment_subprocess_failures_total',
+                                   executable=executable)
+            raise ValueError("Invalid response", str(e))
+        with self.metrics.timer('eopayment_parse_seconds', backend='sips'), \
+                stage(self.tracer, 'parse_output'):
+            result = parse_output(output, record)
+        self.logger.debug('got response %s', result)
         return result
 
+    # notifications are encrypted, the merchant_id is only known after
+    # decoding
+    ROUTING_FIELD = MERCHANT_ID
+    # ATOS transaction ids only have to be unique during their day
+    DAILY_TRANSACTION_ID = True
+
+    def routing_key(self):
+        return self.options.get(MERCHANT_ID, DEFAULT_PARAMS[MERCHANT_ID])
+
+    def notification_key(self, query_string):
+        # the notification is encrypted, identical messages are the same
+        # notification
+        data = scan_fields(query_string, (DATA,)).get(DATA)
+        if data is None:
+            return None
+        return (hashlib.sha1(data).hexdigest(),)
+
     def get_request_params(self):
         params = DEFAULT_PARAMS.copy()
         params.update(self.options)
         return params
 
-    def request(self, amount, email=None, next_url=None):
+    def transaction_id_args(self):
+        return (6, string.digits, 'sips', self.routing_key())
+
+    def request(self, amount, email=None, next_url=None, transaction_id=None,
+            **kwargs):
+        '''Other parameters of the request executable can be given as
+           keyword arguments'''
+        for name in kwargs:
+            if name not in REQUEST_VALID_PARAMS:
+                raise ValueError('unknown sips request parameter %r' % name)
         params = self.get_request_params()
-        transaction_id = self.transaction_id(6, string.digits, 'sips',
-                params[MERCHANT_ID])
+        params.update(kwargs)
+        transaction_id = transaction_id or \
+                self.transaction_id(*self.transaction_id_args())
         params[TRANSACTION_ID] = transaction_id
         params[ORDER_ID] = str(uuid.uuid4()).replace('-', '')
         params['amount'] = str(int(Decimal(amount) * 100))
@@ -142,25 +424,32 @@ class Payment(PaymentCommon):
             params['customer_email'] = email
         if next_url:
             params['normal_return_url'] = next_url
-        params.pop('binpath')
-        code, error, form = self.execute('request', params)
-        if int(code) == 0:
-            return params[ORDER_ID], HTML, form
+        result = self.execute('request', params, RequestResult)
+        if int(result.code) == 0:
+            return params[ORDER_ID], HTML, result.form
         else:
-            raise RuntimeError('sips/request returned -1: %s' % error)
+            raise RuntimeError('sips/request returned -1: %s' % result.error)
+
+    def probe(self, query_string):
+        '''Return the response to a notification which may be meant for
+           another merchant, failed executions are not restarted'''
+        probe = copy.copy(self)
+        probe.pool = self.pool.without_retries()
+        return probe.response(query_string)
 
     def response(self, query_string):
-        form = urlparse.parse_qs(query_string)
-        params = {'message': form[DATA][0]}
-        result = self.execute('response', params)
-        d = dict(zip(RESPONSE_PARAMS, result))
+        with stage(self.tracer, 'parse_qs'):
+            form = query_dict(parse_query(query_string))
+        result = self.decoder.decode(self, form[DATA])
+        d = dict((name, value) for name, value in zip(RESPONSE_PARAMS, result)
+                 if value is not None)
         # The reference identifier for the payment is the authorisation_id
         d[self.BANK_ID] = d.get(AUTHORISATION_ID)
-        self.logger.debug('response contains fields %s' % d)
+        self.logger.debug('response contains fields %s', d)
         response_result = d.get(RESPONSE_CODE) == '00'
         response_code_msg = CB_BANK_RESPONSE_CODES.get(d.get(RESPONSE_CODE))
         response = PaymentResponse(
-                result=response_result,
+                result=PAID if response_result else ERROR,
                 signed=response_result,
                 bank_data=d,
                 order_id=d.get(ORDER_ID),
@@ -10,9 +10,9 @@ import datetime as dt
 import logging
 import re
 
-import Crypto.Cipher.DES
 from common import (PaymentCommon, URL, PaymentResponse, RECEIVED, ACCEPTED,
-        PAID, ERROR)
+        PAID, ERROR, scan_fields, parse_query, query_dict)
+from tracing import stage
 
 __all__ = ['Payment']
 
@@ -55,6 +55,8 @@ def decrypt_ntkey(ntkey):
     return decrypt_key(key)
 
 def decrypt_key(key):
+    # PyCrypto is only needed once, when the key of a merchant is decrypted
+    import Crypto.Cipher.DES
     CIPHER = Crypto.Cipher.DES.new(KEY_DES_KEY, Crypto.Cipher.DES.MODE_CBC, IV)
     return CIPHER.decrypt(key)
 
@@ -67,22 +69,35 @@ def extract_values(query_string):
             result.append(v)
     return ''.join(result)
 
-def sign_ntkey_query(ntkey, query):
+def ntkey_hmac(ntkey):
+    '''Return an HMAC-SHA1 object keyed with the decrypted merchant key, it
+       must be copied before signing a message'''
     key = decrypt_ntkey(ntkey)
-    data_to_sign = extract_values(query)
-    return hmac.new(key[:20], data_to_sign, hashlib.sha1).hexdigest().upper()
+    return hmac.new(key[:20], digestmod=hashlib.sha1)
+
+def sign(key_hmac, data):
+    signer = key_hmac.copy()
+    signer.update(data)
+    return signer.hexdigest().upper()
+
+def sign_query(key_hmac, query):
+    return sign(key_hmac, extract_values(query))
+
+def sign_ntkey_query(ntkey, query):
+    return sign_query(ntkey_hmac(ntkey), query)
 
 PAIEMENT_FIELDS = [ 'siret', REFERENCE, 'langue', 'devise', 'montant',
     'taxe', 'validite' ]
 
-def sign_url_paiement(ntkey, query):
+def sign_paiement(key_hmac, query):
     if '?' in query:
         query = query[query.index('?')+1:]
-    key = decrypt_ntkey(ntkey)
     data = urlparse.parse_qs(query, True)
     fields = [data.get(field,[''])[0] for field in PAIEMENT_FIELDS]
-    data_to_sign = ''.join(fields)
-    return hmac.new(key[:20], data_to_sign, hashlib.sha1).hexdigest().upper()
+    return sign(key_hmac, ''.join(fields))
+
+def sign_url_paiement(ntkey, query):
+    return sign_paiement(ntkey_hmac(ntkey), query)
 
 ALPHANUM = string.letters + string.digits
 SERVICE_URL = "https://www.spplus.net/paiement/init.do"
@@ -120,23 +135,46 @@ class Payment(PaymentCommon):
             ]
     }
     devise = '978'
+    ROUTING_FIELD = 'siret'
+
+    def __init__(self, options, logger=LOGGER):
+        super(Payment, self).__init__(options, logger=logger)
+        # decrypt the key once, signing only copies the keyed HMAC
+        self.hmac = ntkey_hmac(self.cle)
+        # fields which do not change between payments are encoded once
+        self.static_fields = {
+                'siret': str(self.siret),
+                'devise': str(self.devise),
+                'langue': str(self.langue),
+                'taxe': str(self.taxe),
+                'version': '1',
+                'modalite': str(self.modalite),
+                'moyen': str(self.moyen) }
+        self.static_query = urllib.urlencode(self.static_fields)
+
+    def routing_key(self):
+        return self.siret
 
-    def request(self, montant, email=None, next_url=None, logger=LOGGER):
+    def notification_key(self, query_string):
+        values = scan_fields(query_string, (REFERENCE, REFSFP, ETAT))
+        if REFERENCE not in values:
+            return None
+        return tuple(values.get(name) for name in (REFERENCE, REFSFP, ETAT))
+
+    def transaction_id_args(self):
+        return (20, ALPHANUM, 'spplus', self.siret)
+
+    def request(self, montant, email=None, next_url=None, logger=LOGGER,
+            transaction_id=None):
         logger.debug('requesting spplus payment with montant %s email=%s and \
-next_url=%s' % (montant, email, next_url))
-        reference = self.transaction_id(20, ALPHANUM, 'spplus', self.siret)
+next_url=%s', montant, email, next_url)
+        reference = transaction_id or \
+                self.transaction_id(*self.transaction_id_args())
         validite = dt.date.today()+dt.timedelta(days=1)
         validite = validite.strftime('%d/%m/%Y')
-        fields = { 'siret': self.siret,
-                'devise': self.devise,
-                'langue': self.langue,
-                'taxe': self.taxe,
-                'montant': str(Decimal(montant)),
+        fields = { 'montant': str(Decimal(montant)),
                 REFERENCE: reference,
-                'validite': validite,
-                'version': '1',
-                'modalite': self.modalite,
-                'moyen': self.moyen }
+                'validite': validite }
         if email:
             fields['email'] = email
         if next_url:
@@ -145,19 +183,28 @@ next_url=%s' % (montant, email, next_url))
                        or '?' in next_url:
                    raise ValueError('next_url must be an absolute URL without parameters')
             fields['urlretour'] = next_url
-        logger.debug('sending fields %s' % fields)
-        query = urllib.urlencode(fields)
-        url = '%s?%s&hmac=%s' % (SERVICE_URL, query, sign_url_paiement(self.cle,
-            query))
-        logger.debug('full url %s' % url)
+        logger.debug('sending fields %s', fields)
+        static = self.static_fields
+        data_to_sign = ''.join((static['siret'], reference, static['langue'],
+            static['devise'], fields['montant'], static['taxe'], validite))
+        with self.metrics.timer('eopayment_signing_seconds',
+                                backend='spplus'), \
+                stage(self.tracer, 'signature'):
+            signature = sign(self.hmac, data_to_sign)
+        with stage(self.tracer, 'urlencode'):
+            url = '%s?%s&%s&hmac=%s' % (SERVICE_URL, self.static_query,
+                    urllib.urlencode(fields), signature)
+        logger.debug('full url %s', url)
         return reference, URL, url
 
     def response(self, query_string, logger=LOGGER):
-        form = urlparse.parse_qs(query_string)
-        for key, value in form.iteritems():
-            form[key] = value[0]
-        logger.debug('received query_string %s' % query_string)
-        logger.debug('parsed as %s' % form)
+        with self.metrics.timer('eopayment_parse_seconds',
+                                backend='spplus'), \
+                stage(self.tracer, 'parse_qs'):
+            fields = list(parse_query(query_string))
+            form = query_dict(fields)
+        logger.debug('received query_string %s', query_string)
+        logger.debug('parsed as %s', form)
         reference = form.get(REFERENCE)
         bank_status = []
         signed = False
@@ -167,16 +214,20 @@ next_url=%s' % (montant, email, next_url))
         logger.debug('status is %s', status)
         bank_status.append(status)
         if 'hmac' in form:
-            try:
-                signed_data, signature = query_string.rsplit('&', 1)
-                _, hmac = signature.split('=', 1)
-                logger.debug('got signature %s' % hmac)
-                computed_hmac = sign_ntkey_query(self.cle, signed_data)
-                logger.debug('computed signature %s' % computed_hmac)
-                signed = hmac == computed_hmac
-                if not signed:
-                    bank_status.append('invalid signature')
-            except ValueError:
+            # the hmac is the last field, it signs the raw values of the
+            # fields before it
+            received_hmac = fields[-1].raw
+            logger.debug('got signature %s', received_hmac)
+            if fields[-1].name == 'hmac':
+                with self.metrics.timer('eopayment_signing_seconds',
+                                        backend='spplus'), \
+                        stage(self.tracer, 'signature'):
+                    computed_hmac = sign(self.hmac,
+                            ''.join([field.raw for field in fields[:-1]
+                                     if field.name != 'hmac']))
+                logger.debug('computed signature %s', computed_hmac)
+                signed = received_hmac == computed_hmac
+            if not signed:
                 bank_status.append('invalid signature')
         if etat in PAID_STATE:
             result = PAID
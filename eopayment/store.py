@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+'''Stores of processed notifications
+
+Banks can notify the same event many times. When a Payment is given a
+notification store, the response to the first signed notification of an
+event is kept, and later notifications of the same event are answered from
+the store without verifying them again, the returned response has its
+duplicate attribute set to True so that business logic is not run twice:
+
+    >>> store = SQLiteNotificationStore('/var/lib/myapp/notifications.db')
+    >>> payment = Payment(SYSTEMPAY, options, store=store)
+    >>> response = payment.response(query_string)
+    >>> if response.signed and not response.duplicate:
+    ...     validate_invoice(response.order_id)
+
+Events are identified by the backend kind, the merchant (the routing_key() of
+the backend) and the notification_key() of the backend, built from a few
+fields of the query string (order id, bank transaction id and state), so
+that many merchants can share a store. Only signed responses are stored, so a forged
+notification can never be cached; at worst a forged copy of the key of an
+event already processed gets the genuine response of this event.
+
+Two notifications of the same event processed at the same time by two
+workers can both miss the store, the first stored response is kept.
+
+SQLiteNotificationStore keeps the fields of the responses in JSON, a
+database file writable by others can forge responses but cannot run code.
+'''
+
+import json
+import threading
+import time
+
+from allocator import SQLiteDatabase
+from common import PaymentResponse
+
+__all__ = ['NotificationStore', 'MemoryNotificationStore',
+           'SQLiteNotificationStore']
+
+
+def serialize_key(key):
+    return '\x1f'.join('' if part is None else str(part) for part in key)
+
+
+def dump_response(response):
+    '''Encode the fields of a response in JSON, bank_data and bank_status
+       are computed'''
+    return json.dumps(dict((name, getattr(response, name))
+                           for name in PaymentResponse.FIELDS))
+
+
+def load_response(data):
+    values = json.loads(data)
+    if not isinstance(values, dict):
+        raise ValueError('invalid stored response %r' % data)
+    return PaymentResponse(**dict((name, values.get(name))
+                                  for name in PaymentResponse.FIELDS
+                                  if name in values))
+
+
+class NotificationStore(object):
+    '''Base class of notification stores'''
+
+    def get(self, key):
+        '''Return the response stored for key, or None'''
+        raise NotImplementedError
+
+    def add(self, key, response):
+        '''Store response for key if no response is stored yet'''
+        raise NotImplementedError
+
+
+class MemoryNotificationStore(NotificationStore):
+    '''Keep responses in a dictionary of the current process'''
+
+    def __init__(self):
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.responses.get(serialize_key(key))
+
+    def add(self, key, response):
+        with self.lock:
+            self.responses.setdefault(serialize_key(key), response)
+
+
+class SQLiteNotificationStore(SQLiteDatabase, NotificationStore):
+    '''Keep responses in JSON in a SQLite table indexed by key, the database
+       can be shared by all the workers of a host'''
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS notification ('
+              'key TEXT PRIMARY KEY, created REAL, response BLOB)')
+    FILENAME = 'eopayment-notification.sqlite3'
+
+    def get(self, key):
+        row = self.connection.execute('SELECT response FROM notification '
+                                      'WHERE key = ?',
+                                      (serialize_key(key),)).fetchone()
+        if row is None:
+            return None
+        try:
+            return load_response(row[0])
+        except (ValueError, TypeError):
+            # written by an older version, the notification is verified again
+            return None
+
+    def add(self, key, response):
+        try:
+            data = dump_response(response)
+        except (ValueError, TypeError):
+            # bank data which is not text, the notification will be
+            # verified again
+            return
+        self.connection.execute('INSERT OR IGNORE INTO notification '
+                                'VALUES (?, ?, ?)',
+                                (serialize_key(key), time.time(), data))
+
+    def purge(self, retention):
+        '''Remove responses stored more than retention days ago, return the
+           number of removed responses'''
+        cursor = self.connection.execute('DELETE FROM notification '
+                                         'WHERE created < ?',
+                                         (time.time() - retention * 86400,))
+        return cursor.rowcount
@@ -2,15 +2,17 @@
 
 import datetime as dt
 import hashlib
+import heapq
 import logging
 import string
-import urlparse
 import urllib
 from decimal import Decimal
 from gettext import gettext as _
 
-from common import PaymentCommon, PaymentResponse, URL, PAID, ERROR
-from cb import CB_RESPONSE_CODES
+from common import (PaymentCommon, PaymentResponse, URL, PAID, ERROR,
+        scan_fields, parse_query, query_dict)
+from tracing import stage
+from cb import CB_RESPONSE_CODES, CB_RESPONSE_STATUS, status_index, status
 
 __all__ = ['Payment']
 
@@ -26,8 +28,10 @@ VADS_URL_RETURN = 'vads_url_return'
 VADS_AMOUNT = 'vads_amount'
 VADS_SITE_ID = 'vads_site_id'
 VADS_TRANS_ID = 'vads_trans_id'
+VADS_TRANS_STATUS = 'vads_trans_status'
 SIGNATURE = 'signature'
-VADS_TRANS_ID = 'vads_trans_id'
+NOTIFICATION_KEY_FIELDS = (VADS_SITE_ID, VADS_TRANS_DATE, VADS_TRANS_ID,
+        VADS_AUTH_NUMBER, VADS_TRANS_STATUS, VADS_RESULT)
 
 
 def isonow():
@@ -52,29 +56,44 @@ class Parameter:
         self.choices = choices
         self.description = description
         self.help_text = help_text
+        self.check = self.compile_check()
 
     def check_value(self, value):
-        if self.length and len(str(value)) != self.length:
-            return False
-        if self.max_length and len(str(value)) > self.max_length:
-            return False
-        if self.choices and str(value) not in self.choices:
-            return False
-        if value == '':
-            return True
-        value = str(value).replace('.', '')
-        if self.ptype == 'n':
-            return value.isdigit()
-        elif self.ptype == 'an':
-            return value.isalnum()
-        elif self.ptype == 'an-':
-            return value.replace('-', '').isalnum()
-        elif self.ptype == 'an;':
-            return value.replace(';', '').isalnum()
-        elif self.ptype == 'an@':
-            return value.replace('@', '').isalnum()
-        # elif self.ptype == 'ans':
-        return True
+        return self.check(value)
+
+    def compile_check(self):
+        '''Return a function checking values of this parameter, all the
+           tests not depending on the value are resolved here'''
+        length = self.length
+        max_length = self.max_length
+        choices = self.choices
+        type_check = TYPE_CHECKS.get(self.ptype)
+
+        def check(value):
+            if value == '':
+                # an empty value is valid if not constrained in length or
+                # choices
+                return not length and ('' in choices if choices else True)
+            value = str(value)
+            if length and len(value) != length:
+                return False
+            if max_length and len(value) > max_length:
+                return False
+            if choices and value not in choices:
+                return False
+            if type_check is None:
+                return True
+            return type_check(value.replace('.', ''))
+        return check
+
+
+TYPE_CHECKS = {
+        'n': str.isdigit,
+        'an': str.isalnum,
+        'an-': lambda value: value.replace('-', '').isalnum(),
+        'an;': lambda value: value.replace(';', '').isalnum(),
+        'an@': lambda value: value.replace('@', '').isalnum(),
+}
 
 
 PARAMETERS = [
@@ -169,6 +188,18 @@ liste blanche du commerçant",
 d'un des contrôles locaux",
 }
 
+# result codes compiled into their preformatted status
+AUTH_RESULT_STATUS = CB_RESPONSE_STATUS
+RESULT_STATUS = status_index(RESULT_MAP)
+EXTRA_RESULT_STATUS = status_index(EXTRA_RESULT_MAP)
+# when vads_result is 30, vads_extra_result is the code of the parameter in
+# error, some parameters share the same code
+PARAMETER_ERRORS = {}
+for parameter in PARAMETERS:
+    if parameter.code is not None:
+        PARAMETER_ERRORS.setdefault(parameter.code, []).append(
+                'erreur dans le champ %s' % parameter.name)
+
 
 def add_vads(kwargs):
     new_vargs = {}
@@ -180,15 +211,79 @@ def add_vads(kwargs):
     return new_vargs
 
 
+class Schema(object):
+    '''The parameters table compiled for building and validating requests
+       with one pass over the fields'''
+
+    def __init__(self, parameters):
+        self.parameters = dict((p.name, p) for p in parameters)
+        self.defaults = dict((p.name, p.default) for p in parameters
+                if p.default is not None and not callable(p.default))
+        self.dynamic_defaults = [(p.name, p.default) for p in parameters
+                if callable(p.default)]
+        self.required = frozenset(p.name for p in parameters if p.needed)
+        self.checks = dict((p.name, p.check) for p in parameters)
+
+    def dynamic_fields(self, defaults, fields):
+        '''Return fields completed with the dynamic defaults given neither by
+           fields nor by defaults'''
+        dynamic = dict(fields)
+        for name, default in self.dynamic_defaults:
+            if name not in dynamic and name not in defaults:
+                dynamic[name] = default()
+        return dynamic
+
+    def merge_defaults(self, defaults, fields):
+        '''Return fields completed with defaults and dynamic defaults'''
+        merged = defaults.copy()
+        merged.update(self.dynamic_fields(defaults, fields))
+        return merged
+
+    def check(self, fields, exclude=()):
+        missing = self.required.difference(fields, exclude)
+        if missing:
+            raise ValueError('parameter %s must be defined' % min(missing))
+        checks = self.checks
+        for name, value in fields.iteritems():
+            check = checks.get(name)
+            if check is not None and not check(value):
+                raise ValueError('parameter %s value %s is not of the type %s' % (
+                    name, value, self.parameters[name].ptype))
+
+
+SCHEMA = Schema(PARAMETERS)
+
+
 def check_vads(kwargs, exclude=[]):
-    for parameter in PARAMETERS:
-        name = parameter.name
-        if name not in kwargs and name not in exclude and parameter.needed:
-            raise ValueError('parameter %s must be defined' % name)
-        if name in kwargs and not parameter.check_value(kwargs[name]):
-            raise ValueError('parameter %s value %s is not of the type %s' % (
-                name, kwargs[name],
-                parameter.ptype))
+    SCHEMA.check(kwargs, exclude)
+
+
+class Signer(object):
+    '''Sign fields completing a fixed set of static fields.
+
+       The signature is the SHA-1 of the values of the vads_ fields ordered
+       by name, joined with + and followed by the secret. The static fields
+       are ordered and serialized once, sign() only orders the fields it is
+       given and merges them with the static ones.
+    '''
+
+    def __init__(self, secret, static=None):
+        self.secret = secret
+        self.static = sorted((key, str(value)) for key, value
+                in (static or {}).iteritems() if key.startswith('vads_'))
+        self.keys = frozenset(key for key, value in self.static)
+
+    def sign(self, fields=None):
+        '''Sign the static fields overridden and completed by fields'''
+        fields = fields or {}
+        dynamic = sorted((key, str(value)) for key, value
+                in fields.iteritems() if key.startswith('vads_'))
+        static = self.static
+        if not self.keys.isdisjoint(fields):
+            static = [item for item in static if item[0] not in fields]
+        signed_data = '+'.join([value for key, value
+                                in heapq.merge(static, dynamic)])
+        return hashlib.sha1('%s+%s' % (signed_data, self.secret)).hexdigest()
 
 
 class Payment(PaymentCommon):
@@ -249,11 +344,36 @@ class Payment(PaymentCommon):
         self.service_url = options.pop('service_url', SERVICE_URL)
         self.secret_test = options.pop('secret_test')
         self.secret_production = options.pop('secret_production', None)
+        self.secrets = {
+            'test': self.secret_test,
+            'production': self.secret_production,
+        }
+        self.setup(options)
         options = add_vads(options)
         self.options = options
         self.logger = logger
+        # module defaults overridden by the configuration
+        self.defaults = SCHEMA.defaults.copy()
+        self.defaults.update((name, value) for name, value in options.iteritems()
+                if name in SCHEMA.parameters)
+        self.signer = Signer(self.secret(self.defaults['vads_ctx_mode']),
+                self.defaults)
+        # fields which do not change between payments are checked and encoded
+        # once, requests only encode the fields of the payment
+        self.static_keys = frozenset(self.defaults)
+        self.static_query = urllib.urlencode(self.defaults)
+        try:
+            SCHEMA.check(self.defaults, exclude=SCHEMA.required)
+            self.static_valid = True
+        except ValueError:
+            # reported by each request
+            self.static_valid = False
+
+    def transaction_id_args(self):
+        return (6, string.digits, 'systempay', self.options[VADS_SITE_ID])
 
-    def request(self, amount, email=None, next_url=None, **kwargs):
+    def request(self, amount, email=None, next_url=None, transaction_id=None,
+            **kwargs):
         '''
            Create a dictionary to send a payment request to systempay the
            Credit Card payment server of the NATIXIS group
@@ -270,99 +390,181 @@ class Payment(PaymentCommon):
         if next_url:
             kwargs[VADS_URL_RETURN] = next_url
 
-        transaction_id = self.transaction_id(6,
-                string.digits, 'systempay', self.options[VADS_SITE_ID])
+        transaction_id = transaction_id or \
+                self.transaction_id(*self.transaction_id_args())
         kwargs[VADS_TRANS_ID] = transaction_id
-        fields = kwargs
-        for parameter in PARAMETERS:
-            name = parameter.name
-            # import default parameters from configuration
-            if name not in fields \
-                    and name in self.options:
-                fields[name] = self.options[name]
-            # import default parameters from module
-            if name not in fields and parameter.default is not None:
-                if callable(parameter.default):
-                    fields[name] = parameter.default()
-                else:
-                    fields[name] = parameter.default
-        check_vads(fields)
-        fields[SIGNATURE] = self.signature(fields)
-        self.logger.debug('%s request contains fields: %s', __name__, fields)
-        url = '%s?%s' % (SERVICE_URL, urllib.urlencode(fields))
+        metrics, tracer = self.metrics, self.tracer
+        with stage(tracer, 'merge_defaults'):
+            dynamic = SCHEMA.dynamic_fields(self.defaults, kwargs)
+        if self.static_valid and self.static_keys.isdisjoint(dynamic):
+            with metrics.timer('eopayment_validation_seconds',
+                               backend='systempayv2'), \
+                    stage(tracer, 'check_vads'):
+                SCHEMA.check(dynamic, exclude=self.static_keys)
+            with metrics.timer('eopayment_signing_seconds',
+                               backend='systempayv2'), \
+                    stage(tracer, 'signature'):
+                dynamic[SIGNATURE] = self.signer.sign(dynamic)
+            self.logger.debug('%s request contains fields: %s', __name__,
+                    dynamic)
+            with stage(tracer, 'urlencode'):
+                url = '%s?%s&%s' % (SERVICE_URL, self.static_query,
+                        urllib.urlencode(dynamic))
+            trans_date = dynamic.get(VADS_TRANS_DATE) \
+                    or self.defaults[VADS_TRANS_DATE]
+        else:
+            with stage(tracer, 'merge_defaults'):
+                fields = self.defaults.copy()
+                fields.update(dynamic)
+            with metrics.timer('eopayment_validation_seconds',
+                               backend='systempayv2'), \
+                    stage(tracer, 'check_vads'):
+                check_vads(fields)
+            with metrics.timer('eopayment_signing_seconds',
+                               backend='systempayv2'), \
+                    stage(tracer, 'signature'):
+                fields[SIGNATURE] = self.signature(fields)
+            self.logger.debug('%s request contains fields: %s', __name__,
+                    fields)
+            with stage(tracer, 'urlencode'):
+                url = '%s?%s' % (SERVICE_URL, urllib.urlencode(fields))
+            trans_date = fields[VADS_TRANS_DATE]
         self.logger.debug('%s return url %s', __name__, url)
-        transaction_id = '%s_%s' % (fields[VADS_TRANS_DATE], transaction_id)
+        transaction_id = '%s_%s' % (trans_date, transaction_id)
         self.logger.debug('%s transaction id: %s', __name__, transaction_id)
         return transaction_id, URL, url
 
-    def response(self, query_string):
-        fields = urlparse.parse_qs(query_string, True)
-        for key, value in fields.iteritems():
-            fields[key] = value[0]
+    ROUTING_FIELD = VADS_SITE_ID
+    # vads_trans_id only has to be unique during the day of vads_trans_date
+    DAILY_TRANSACTION_ID = True
+
+    def routing_key(self):
+        return str(self.options[VADS_SITE_ID])
+
+    def transaction_id_utilisation(self):
+        '''Report how many of the 1,000,000 daily vads_trans_id of the site
+           are used, only for allocators providing utilisation()'''
+        return self.allocator.utilisation(6, string.digits, 'systempay',
+                self.options[VADS_SITE_ID])
+
+    def notification_key(self, query_string):
+        values = scan_fields(query_string, NOTIFICATION_KEY_FIELDS)
+        if VADS_TRANS_ID not in values:
+            return None
+        return tuple(values.get(name) for name in NOTIFICATION_KEY_FIELDS)
+
+    def decode(self, fields, signed):
+        '''Return the fields annotated with the meaning of the result codes
+           and the bank status'''
         copy = fields.copy()
         bank_status = []
         if VADS_AUTH_RESULT in fields:
-            v = copy[VADS_AUTH_RESULT]
-            ctx = (v, AUTH_RESULT_MAP.get(v, 'Code inconnu'))
-            copy[VADS_AUTH_RESULT] = '%s: %s' % ctx
+            copy[VADS_AUTH_RESULT] = status(AUTH_RESULT_STATUS,
+                    fields[VADS_AUTH_RESULT])
             bank_status.append(copy[VADS_AUTH_RESULT])
-        if VADS_RESULT in copy:
-            v = copy[VADS_RESULT]
-            ctx = (v, RESULT_MAP.get(v, 'Code inconnu'))
-            copy[VADS_RESULT] = '%s: %s' % ctx
+        if VADS_RESULT in fields:
+            v = fields[VADS_RESULT]
+            copy[VADS_RESULT] = status(RESULT_STATUS, v)
             bank_status.append(copy[VADS_RESULT])
             if v == '30':
                 if VADS_EXTRA_RESULT in fields:
                     v = fields[VADS_EXTRA_RESULT]
                     if v.isdigit():
-                        for parameter in PARAMETERS:
-                            if int(v) == parameter.code:
-                                s = 'erreur dans le champ %s' % parameter.name
-                                copy[VADS_EXTRA_RESULT] = s
-                                bank_status.append(copy[VADS_EXTRA_RESULT])
+                        for s in PARAMETER_ERRORS.get(int(v), ()):
+                            copy[VADS_EXTRA_RESULT] = s
+                            bank_status.append(s)
             elif v in ('05', '00'):
                 if VADS_EXTRA_RESULT in fields:
-                    v = fields[VADS_EXTRA_RESULT]
-                    copy[VADS_EXTRA_RESULT] = '%s: %s' % (v,
-                            EXTRA_RESULT_MAP.get(v, 'Code inconnu'))
+                    copy[VADS_EXTRA_RESULT] = status(EXTRA_RESULT_STATUS,
+                            fields[VADS_EXTRA_RESULT])
                     bank_status.append(copy[VADS_EXTRA_RESULT])
-        self.logger.debug('checking systempay response on:')
-        for key in sorted(fields.keys()):
-            self.logger.debug('  %s: %s' % (key, copy[key]))
-        signature = self.signature(fields)
+        if not signed:
+            bank_status.append('invalid signature')
+        # the VADS_AUTH_NUMBER is the number to match payment in bank logs
+        copy[self.BANK_ID] = copy.get(VADS_AUTH_NUMBER, '')
+        return copy, ' - '.join(bank_status)
+
+    def response(self, query_string):
+        metrics, tracer = self.metrics, self.tracer
+        with metrics.timer('eopayment_parse_seconds',
+                           backend='systempayv2'), \
+                stage(tracer, 'parse_qs'):
+            fields = query_dict(parse_query(query_string), True)
+        with metrics.timer('eopayment_signing_seconds',
+                           backend='systempayv2'), \
+                stage(tracer, 'signature'):
+            signature = self.signature(fields)
         signature_result = signature == fields[SIGNATURE]
         self.logger.debug('signature check: %s <!> %s', signature,
                 fields[SIGNATURE])
-        if not signature_result:
-            bank_status.append('invalid signature')
+        # bank data and status are only decoded when accessed
+        decoded = []
+
+        def decode():
+            if not decoded:
+                decoded.extend(self.decode(fields, signature_result))
+            return decoded
+        if self.logger.isEnabledFor(logging.DEBUG):
+            copy = decode()[0]
+            self.logger.debug('checking systempay response on:')
+            for key in sorted(fields.keys()):
+                self.logger.debug('  %s: %s', key, copy[key])
 
         if fields[VADS_AUTH_RESULT] == '00':
             result = PAID
         else:
             result = ERROR
-        transaction_id = '%s_%s' % (copy[VADS_TRANS_DATE], copy[VADS_TRANS_ID])
-        # the VADS_AUTH_NUMBER is the number to match payment in bank logs
-        copy[self.BANK_ID] = copy.get(VADS_AUTH_NUMBER, '')
+        transaction_id = '%s_%s' % (fields[VADS_TRANS_DATE],
+                fields[VADS_TRANS_ID])
         response = PaymentResponse(
                 result=result,
                 signed=signature_result,
-                bank_data=copy,
+                bank_data=lambda: decode()[0],
                 order_id=transaction_id,
-                transaction_id=copy.get(VADS_AUTH_NUMBER),
-                bank_status=' - '.join(bank_status))
+                transaction_id=fields.get(VADS_AUTH_NUMBER),
+                bank_status=lambda: decode()[1])
         return response
 
+    def secret(self, ctx_mode):
+        return self.secrets[ctx_mode.lower()]
+
+    def verify(self, query_string):
+        '''Check the signature of a notification directly on its query
+           string'''
+        items = []
+        seen = set()
+        signature = ctx_mode = None
+        for field in parse_query(query_string):
+            name = field.name
+            # like parse_qs, the first value of a field wins
+            if name in seen:
+                continue
+            seen.add(name)
+            if name.startswith('vads_'):
+                items.append((name, field.value))
+                if name == 'vads_ctx_mode':
+                    ctx_mode = field.value
+            elif name == SIGNATURE:
+                signature = field.value
+        if signature is None or ctx_mode is None \
+                or ctx_mode.lower() not in self.secrets:
+            return False
+        items.sort()
+        signed_data = '+'.join([value for name, value in items])
+        signed_data = '%s+%s' % (signed_data, self.secret(ctx_mode))
+        return hashlib.sha1(signed_data).hexdigest() == signature
+
     def signature(self, fields):
-        self.logger.debug('got fields %s to sign' % fields)
+        self.logger.debug('got fields %s to sign', fields)
         ordered_keys = sorted([key for key in fields.keys() if key.startswith('vads_')])
-        self.logger.debug('ordered keys %s' % ordered_keys)
+        self.logger.debug('ordered keys %s', ordered_keys)
         ordered_fields = [str(fields[key]) for key in ordered_keys]
-        secret = getattr(self, 'secret_%s' % fields['vads_ctx_mode'].lower())
+        secret = self.secret(fields['vads_ctx_mode'])
         signed_data = '+'.join(ordered_fields)
         signed_data = '%s+%s' % (signed_data, secret)
-        self.logger.debug('generating signature on «%s»' % signed_data)
+        self.logger.debug('generating signature on «%s»', signed_data)
         sign = hashlib.sha1(signed_data).hexdigest()
-        self.logger.debug('signature «%s»' % sign)
+        self.logger.debug('signature «%s»', sign)
         return sign
 
 if __name__ == '__main__':
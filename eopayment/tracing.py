@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+'''Tracing of the internal stages of the payment operations
+
+A tracer is a callable receiving an event for the beginning and the end of
+each stage:
+
+    tracer(event, stage, timestamp, attributes)
+
+event is 'begin' or 'end', timestamp is given by time.time() and attributes
+is a dictionary describing the stage, at the end it also contains its
+duration in seconds and, when the stage raised an exception, its error.
+Stages are nested, they are reported by the thread running them:
+
+    >>> recorder = Recorder()
+    >>> payment = Payment(SYSTEMPAY, options, tracer=recorder)
+    >>> payment.request(10)
+    >>> for stage, duration, depth in recorder.stages():
+    ...     print '%s%s %.1fus' % ('  ' * depth, stage, duration * 1e6)
+
+The stages are get_backend, request, response, transaction_id,
+merge_defaults, check_vads, signature, urlencode, parse_qs and for SIPS
+execute and parse_output. Without tracer, a stage costs a function call
+returning a shared context manager which does nothing.
+
+OpenTelemetryTracer turns stages into spans of an OpenTelemetry tracer, the
+opentelemetry module is only needed by this adapter.
+'''
+
+import threading
+import time
+
+__all__ = ['Recorder', 'OpenTelemetryTracer', 'stage', 'record', 'TRACER']
+
+TRACER = 'tracer'
+
+
+class Stage(object):
+    '''Context manager sending the begin and end events of a stage'''
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = time.time()
+        self.tracer('begin', self.name, self.start, self.attributes)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        attributes = dict(self.attributes, duration=end - self.start)
+        if exc_type is not None:
+            attributes['error'] = repr(exc_value)
+        self.tracer('end', self.name, end, attributes)
+
+
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_STAGE = NullStage()
+
+
+def stage(tracer, name, **attributes):
+    '''Return a context manager tracing name with tracer, if any'''
+    if tracer is None:
+        return NULL_STAGE
+    return Stage(tracer, name, attributes)
+
+
+def record(tracer, name, start, end, error=None, **attributes):
+    '''Send the events of a stage which ran elsewhere, for example in a
+       worker process, from start to end'''
+    if tracer is None:
+        return
+    tracer('begin', name, start, attributes)
+    attributes = dict(attributes, duration=end - start)
+    if error is not None:
+        attributes['error'] = repr(error)
+    tracer('end', name, end, attributes)
+
+
+class Recorder(object):
+    '''Tracer keeping the events in memory'''
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def __call__(self, event, stage, timestamp, attributes):
+        with self.lock:
+            self.events.append((event, stage, timestamp, attributes,
+                                threading.current_thread().ident))
+
+    def stages(self):
+        '''Return the (stage, duration, depth) triples of the completed
+           stages in the order of their beginning'''
+        result = []
+        depths = {}
+        with self.lock:
+            events = list(self.events)
+        for event, stage, timestamp, attributes, thread in events:
+            stack = depths.setdefault(thread, [])
+            if event == 'begin':
+                stack.append(len(result))
+                result.append([stage, None, len(stack) - 1])
+            elif stack:
+                result[stack.pop()][1] = attributes['duration']
+        return [tuple(item) for item in result if item[1] is not None]
+
+    def clear(self):
+        with self.lock:
+            del self.events[:]
+
+
+class OpenTelemetryTracer(object):
+    '''Report the stages as spans of an OpenTelemetry tracer, by default the
+       tracer of the eopayment instrumentation'''
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            from opentelemetry import trace
+            tracer = trace.get_tracer('eopayment')
+        self.tracer = tracer
+        self.local = threading.local()
+
+    def __call__(self, event, stage, timestamp, attributes):
+        stack = self.local.__dict__.setdefault('stack', [])
+        if event == 'begin':
+            manager = self.tracer.start_as_current_span(stage,
+                    attributes=attributes, start_time=int(timestamp * 1e9))
+            stack.append((manager, manager.__enter__()))
+        elif stack:
+            manager, span = stack.pop()
+            span.set_attributes(attributes)
+            manager.__exit__(None, None, None)
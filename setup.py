@@ -55,6 +55,8 @@ distutils.core.setup(name='eopayment',
         maintainer="Benjamin Dauvergne",
         maintainer_email="bdauvergne@entrouvert.com",
         packages=['eopayment'],
+        # fake SIPS executables used by python -m eopayment.bench
+        package_data={'eopayment': ['request', 'response']},
         requires=[
             'pycrypto (>= 2.5)'
         ],
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+from datetime import date, timedelta
+from unittest import TestCase
+
+import eopayment.allocator as allocator
+
+
+class AllocatorTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def check_allocator(self, instance):
+        self.assertTrue(instance.reserve('000001', 'test', '1234'))
+        self.assertFalse(instance.reserve('000001', 'test', '1234'))
+        self.assertTrue(instance.reserve('000001', 'test', '5678'))
+        ids = set(instance.allocate(2, '0123456789', 'test')
+                  for i in range(100))
+        self.assertEqual(len(ids), 100)
+
+    def test_file(self):
+        instance = allocator.FileAllocator(self.path)
+        self.check_allocator(instance)
+        self.assertEqual(len(os.listdir(self.path)), 102)
+
+    def test_memory(self):
+        self.check_allocator(allocator.MemoryAllocator())
+
+    def test_memory_new_day(self):
+        instance = allocator.MemoryAllocator()
+        yesterday = date.today() - timedelta(days=1)
+        instance.days[yesterday] = {(('test',), '000001'): object()}
+        self.assertTrue(instance.reserve('000001', 'test'))
+        self.assertFalse(instance.reserve('000001', 'test'))
+        self.assertEqual(instance.days.keys(), [date.today()])
+
+    def test_sqlite(self):
+        self.check_allocator(allocator.SQLiteAllocator(self.path))
+        # another instance on the same database sees the reservations
+        other = allocator.SQLiteAllocator(self.path)
+        self.assertFalse(other.reserve('000001', 'test', '1234'))
+
+    def test_get_allocator(self):
+        options = {'transaction_id_allocator': 'sqlite', 'siret': '1234'}
+        instance = allocator.get_allocator(options, self.path)
+        self.assertTrue(isinstance(instance, allocator.SQLiteAllocator))
+        self.assertEqual(options, {'siret': '1234'})
+        instance = allocator.get_allocator({}, self.path)
+        self.assertTrue(isinstance(instance, allocator.FileAllocator))
+        self.assertEqual(instance.path, self.path)
+        self.assertRaises(ValueError, allocator.get_allocator,
+                          {'transaction_id_allocator': 'foo'}, self.path)
+
+    def test_sequence(self):
+        instance = allocator.SequenceAllocator(self.path, block_size=10)
+        other = allocator.SequenceAllocator(self.path, block_size=10)
+        self.assertEqual(instance.allocate(6, '0123456789', 'test'), '000000')
+        self.assertEqual(other.allocate(6, '0123456789', 'test'), '000010')
+        self.assertEqual(instance.allocate(6, '0123456789', 'test'), '000001')
+        utilisation = instance.utilisation(6, '0123456789', 'test')
+        self.assertEqual(utilisation['leased'], 20)
+        self.assertEqual(utilisation['capacity'], 1000000)
+        self.assertEqual(utilisation['issued_by_process'], 2)
+        ids = [instance.allocate(1, '01', 'small') for i in range(2)]
+        self.assertEqual(ids, ['0', '1'])
+        self.assertRaises(RuntimeError, instance.allocate, 1, '01', 'small')
+        self.assertEqual(instance.allocate_many(3, 6, '0123456789', 'test'),
+                         ['000020', '000021', '000022'])
+        self.assertEqual(instance.allocate(6, '0123456789', 'test'), '000002')
+        self.assertRaises(RuntimeError, instance.allocate_many, 3, 1, '01',
+                          'other')
+        # the refused lease did not burn the remaining ids
+        self.assertEqual(instance.allocate_many(2, 1, '01', 'other'),
+                         ['0', '1'])
+
+    def test_sequence_reserve(self):
+        instance = allocator.SequenceAllocator(self.path)
+        self.assertRaises(NotImplementedError, instance.reserve, '000001',
+                          'test')
+        self.assertEqual(instance.purge(7).removed, 0)
+
+    def test_sequence_backends(self):
+        import eopayment
+        options = {'transaction_id_allocator': 'sequence',
+                   'transaction_id_path': self.path}
+        self.assertRaises(ValueError, eopayment.Payment, eopayment.DUMMY,
+                          dict(options, siret='1234'))
+        payment = eopayment.Payment(eopayment.SYSTEMPAY, dict(options,
+            secret_test='2662931409789978', site_id='93413345',
+            ctx_mode='TEST'))
+        transaction_id = payment.request(10)[0]
+        self.assertTrue(transaction_id.endswith('_000000'))
+
+    def test_allocate_many(self):
+        for instance in (allocator.MemoryAllocator(),
+                         allocator.SQLiteAllocator(self.path)):
+            ids = instance.allocate_many(50, 2, '0123456789', 'test')
+            self.assertEqual(len(set(ids)), 50)
+            for id in ids:
+                self.assertFalse(instance.reserve(id, 'test'))
+
+    def test_purge(self):
+        old = date.today() - timedelta(days=10)
+        for name in ('%s_test_000001' % old, '%s_test_000002' % old,
+                     'unrelated'):
+            open(os.path.join(self.path, name), 'w').close()
+        os.mkdir(os.path.join(self.path, str(old)))
+        open(os.path.join(self.path, str(old), 'test_000001'), 'w').close()
+        instance = allocator.ShardedFileAllocator(self.path)
+        self.assertTrue(instance.reserve('000001', 'test'))
+        self.assertFalse(instance.reserve('000001', 'test'))
+        report = instance.purge(7)
+        self.assertEqual(report.removed, 3)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         [str(date.today()), 'unrelated'])
+
+    def test_purge_foreign_entries(self):
+        old = date.today() - timedelta(days=10)
+        # entries of other programs named like reservations
+        with open(os.path.join(self.path, '%s_backup_001' % old), 'w') as f:
+            f.write('data')
+        os.mkdir(os.path.join(self.path, '%s_logs' % old))
+        day = os.path.join(self.path, str(old))
+        os.mkdir(day)
+        os.mkdir(os.path.join(day, 'nested'))
+        open(os.path.join(day, 'nested', 'test_000001'), 'w').close()
+        open(os.path.join(day, 'test_000002'), 'w').close()
+        open(os.path.join(self.path, '%s_test_000003' % old), 'w').close()
+        report = allocator.ShardedFileAllocator(self.path).purge(7)
+        self.assertEqual(report.removed, 2)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         [str(old), '%s_backup_001' % old, '%s_logs' % old])
+        self.assertEqual(os.listdir(day), ['nested'])
+
+    def test_purge_sqlite(self):
+        instance = allocator.SQLiteAllocator(self.path)
+        instance.reserve('000001', 'test')
+        self.assertEqual(instance.purge(7).removed, 0)
+        later = date.today() + timedelta(days=10)
+        self.assertEqual(instance.purge(7, today=later).removed, 1)
@@ -0,0 +1,20 @@
+from unittest import TestCase
+
+import eopayment.bench as bench
+
+
+class BenchTest(TestCase):
+    def test_run(self):
+        results = bench.run(iterations=3)
+        names = [result.name for result in results]
+        for kind in bench.BENCHMARKS:
+            self.assertTrue('%s request' % kind in names)
+            self.assertTrue('%s response' % kind in names)
+            self.assertTrue('%s request (debug)' % kind in names)
+        self.assertTrue('%s request (full encoding)' % bench.SYSTEMPAY
+                        in names)
+        self.assertTrue('allocator file' in names)
+        for result in results:
+            self.assertEqual(result.iterations, 3)
+            self.assertTrue(result.p50 <= result.p99 <= result.max)
+            str(result)
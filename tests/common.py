@@ -0,0 +1,49 @@
+import urlparse
+from unittest import TestCase
+
+from eopayment.common import parse_query, query_dict, PaymentResponse, PAID
+
+
+class ParseQueryTest(TestCase):
+    queries = [
+        'a=1&b=2',
+        'a=1&a=2&b=&c',
+        'x=wdwd%20%3Fdfgfdgd&z=343+2&hmac=04233b78bb5',
+        'a%5B%5D=%C3%A9&&b=1&',
+        '',
+    ]
+
+    def test_parse_query(self):
+        fields = list(parse_query('x=a%20b&y=&z'))
+        self.assertEqual([tuple(field) for field in fields], [
+            ('x', 'a%20b', 'a b', 2, 7),
+            ('y', '', '', 10, 10),
+            ('z', '', '', 12, 12)])
+
+    def test_query_dict(self):
+        for query in self.queries:
+            for keep_blank_values in (True, False):
+                expected = dict((k, v[0]) for k, v in urlparse.parse_qs(
+                    query, keep_blank_values).iteritems())
+                self.assertEqual(query_dict(parse_query(query),
+                                            keep_blank_values), expected)
+
+
+class PaymentResponseTest(TestCase):
+    def test_lazy(self):
+        calls = []
+
+        def bank_data():
+            calls.append(1)
+            return {'a': 1}
+        response = PaymentResponse(result=PAID, bank_data=bank_data)
+        self.assertEqual(calls, [])
+        self.assertEqual(response.bank_data, {'a': 1})
+        self.assertEqual(response.bank_data, {'a': 1})
+        self.assertEqual(calls, [1])
+        self.assertTrue(response.is_paid())
+        self.assertTrue(response.copy(duplicate=True).duplicate)
+        self.assertRaises(AttributeError, setattr, response, 'result', None)
+        self.assertEqual(PaymentResponse().bank_data, {})
+        self.assertFalse(PaymentResponse().bank_data is
+                         PaymentResponse().bank_data)
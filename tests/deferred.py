@@ -0,0 +1,38 @@
+from unittest import TestCase
+
+import eopayment
+from eopayment.deferred import AsyncPayment, Executor, Future, TimeoutError
+
+from tests.payment import OPTIONS
+
+
+class AsyncPaymentTest(TestCase):
+    def test_request_response(self):
+        for executor in (None, Executor(2)):
+            payment = AsyncPayment(eopayment.DUMMY, dict(OPTIONS),
+                                   executor=executor)
+            transaction_id, kind, url = payment.request('10.00').result(5)
+            self.assertEqual(kind, eopayment.URL)
+            results = []
+            future = payment.response('transaction_id=%s&ok=1&signed=1'
+                                      % transaction_id)
+            future.add_done_callback(lambda f: results.append(f.result()))
+            response = future.result(5)
+            self.assertTrue(response.is_paid())
+            self.assertEqual(response.order_id, transaction_id)
+            payment.shutdown()
+            self.assertEqual(results, [response])
+
+    def test_exception(self):
+        executor = Executor(1)
+        future = executor.submit(int, 'x')
+        self.assertRaises(ValueError, future.result, 5)
+        self.assertTrue(isinstance(future.exception(), ValueError))
+        executor.shutdown()
+
+    def test_timeout(self):
+        future = Future()
+        self.assertRaises(TimeoutError, future.result, 0.01)
+        self.assertRaises(TimeoutError, future.exception, 0.01)
+        future.set_result(1)
+        self.assertEqual(future.result(0.01), 1)
@@ -0,0 +1,53 @@
+import os.path
+import subprocess
+import sys
+from unittest import TestCase
+
+import eopayment
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = '''
+import sys, time
+start = time.time()
+import eopayment
+elapsed = time.time() - start
+eopayment.get_metadata(eopayment.SPPLUS)
+print elapsed
+print ' '.join(sorted(name for name in sys.modules if sys.modules[name]))
+'''
+
+
+class ImportTest(TestCase):
+    def run_script(self, script):
+        env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='1')
+        output = subprocess.Popen([sys.executable, '-c', script],
+                                  stdout=subprocess.PIPE, env=env,
+                                  cwd=ROOT).communicate()[0]
+        elapsed, modules = output.splitlines()
+        return float(elapsed), set(modules.split())
+
+    def test_lazy_import(self):
+        elapsed, modules = self.run_script(SCRIPT)
+        for name in ('eopayment.spplus', 'eopayment.systempayv2',
+                     'eopayment.sips', 'eopayment.dummy', 'Crypto',
+                     'urllib', 'sqlite3', 'multiprocessing',
+                     'prometheus_client', 'opentelemetry'):
+            self.assertFalse(name in modules, name)
+        # generous bound, the import takes a few milliseconds
+        self.assertTrue(elapsed < 1.0, elapsed)
+
+    def test_crypto_import_deferred(self):
+        elapsed, modules = self.run_script(SCRIPT.replace(
+            'import eopayment\n', 'import eopayment.spplus\n'))
+        self.assertFalse('Crypto' in modules)
+
+    def test_metadata(self):
+        for kind in eopayment.registry.METADATA:
+            metadata = eopayment.get_metadata(kind)
+            description = eopayment.get_backend(kind).description
+            self.assertEqual(metadata['caption'], description['caption'])
+            self.assertEqual(metadata['parameters'],
+                             tuple(parameter['name'] for parameter
+                                   in description['parameters']))
+        self.assertRaises(ValueError, eopayment.get_metadata, 'unknown')
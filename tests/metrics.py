@@ -0,0 +1,121 @@
+from unittest import TestCase
+
+import eopayment
+import eopayment.allocator as allocator
+import eopayment.metrics as metrics
+
+from tests.payment import OPTIONS as DUMMY_OPTIONS
+from tests.systempayv2 import OPTIONS, QUERY_STRING
+
+
+class CollidingAllocator(allocator.MemoryAllocator):
+    def __init__(self):
+        super(CollidingAllocator, self).__init__()
+        self.refused = 2
+
+    def reserve(self, id, *prefixes):
+        if self.refused:
+            self.refused -= 1
+            return False
+        return super(CollidingAllocator, self).reserve(id, *prefixes)
+
+
+class MetricsTest(TestCase):
+    def test_memory_metrics(self):
+        collector = metrics.MemoryMetrics(buckets=(0.1, 1))
+        collector.increment('calls_total', backend='a')
+        collector.increment('calls_total', 2, backend='a')
+        collector.observe('duration_seconds', 0.5, backend='a')
+        with collector.timer('duration_seconds', backend='a'):
+            pass
+        self.assertEqual(collector.counter('calls_total', backend='a'), 3)
+        self.assertEqual(collector.count('duration_seconds', backend='a'), 2)
+        lines = collector.render().splitlines()
+        self.assertTrue('# TYPE calls_total counter' in lines)
+        self.assertTrue('calls_total{backend="a"} 3' in lines)
+        self.assertTrue('# TYPE duration_seconds histogram' in lines)
+        self.assertTrue('duration_seconds_bucket{backend="a",le="0.1"} 1'
+                        in lines)
+        self.assertTrue('duration_seconds_bucket{backend="a",le="1"} 2'
+                        in lines)
+        self.assertTrue('duration_seconds_bucket{backend="a",le="+Inf"} 2'
+                        in lines)
+        self.assertTrue('duration_seconds_count{backend="a"} 2' in lines)
+
+    def test_null_metrics(self):
+        with metrics.NULL_METRICS.timer('duration_seconds'):
+            metrics.NULL_METRICS.increment('calls_total')
+
+    def test_payment(self):
+        collector = metrics.MemoryMetrics()
+        options = dict(OPTIONS, transaction_id_allocator=CollidingAllocator())
+        payment = eopayment.Payment(eopayment.SYSTEMPAY, options,
+                                    metrics=collector)
+        self.assertFalse('metrics' in payment.options)
+        payment.request(10)
+        payment.response(QUERY_STRING)
+        payment.response(QUERY_STRING.replace('vads_amount=100',
+                                              'vads_amount=1'))
+        self.assertRaises(KeyError, payment.response, 'vads_amount=1')
+        kind = eopayment.SYSTEMPAY
+        self.assertEqual(collector.count('eopayment_request_seconds',
+                                         backend=kind), 1)
+        self.assertEqual(collector.count('eopayment_response_seconds',
+                                         backend=kind), 3)
+        self.assertEqual(collector.counter('eopayment_responses_total',
+                                           backend=kind, signed=True), 1)
+        self.assertEqual(collector.counter(
+            'eopayment_signature_failures_total', backend=kind), 1)
+        self.assertEqual(collector.counter('eopayment_errors_total',
+                                           backend=kind,
+                                           operation='response'), 1)
+        self.assertEqual(collector.counter(
+            'eopayment_transaction_id_collisions_total',
+            allocator='CollidingAllocator'), 2)
+        self.assertEqual(collector.count('eopayment_transaction_id_seconds',
+                                         allocator='CollidingAllocator'), 1)
+        for name in ('eopayment_validation_seconds',
+                     'eopayment_signing_seconds', 'eopayment_parse_seconds'):
+            self.assertTrue(collector.count(name, backend=kind) > 0)
+
+    def test_shared_allocator(self):
+        shared = CollidingAllocator()
+        collectors = [metrics.MemoryMetrics(), metrics.MemoryMetrics()]
+        payments = [eopayment.Payment(eopayment.SYSTEMPAY,
+                        dict(OPTIONS, transaction_id_allocator=shared),
+                        metrics=collector)
+                    for collector in collectors]
+        self.assertFalse(hasattr(shared, 'metrics'))
+        payments[0].request(10)
+        self.assertEqual(collectors[0].counter(
+            'eopayment_transaction_id_collisions_total',
+            allocator='CollidingAllocator'), 2)
+        self.assertEqual(collectors[1].counter(
+            'eopayment_transaction_id_collisions_total',
+            allocator='CollidingAllocator'), 0)
+
+    def test_batches(self):
+        query_strings = ['transaction_id=a&ok=1&signed=1',
+                         'transaction_id=b&ok=1']
+        kind = eopayment.DUMMY
+        for processes in (None, 2):
+            collector = metrics.MemoryMetrics()
+            payment = eopayment.Payment(kind, dict(DUMMY_OPTIONS),
+                                        metrics=collector)
+            list(payment.response_many(query_strings, processes=processes))
+            list(payment.request_many([('10.00', None, None)] * 3,
+                                      processes=processes))
+            self.assertEqual(collector.count('eopayment_response_seconds',
+                                             backend=kind), 2)
+            self.assertEqual(collector.count('eopayment_request_seconds',
+                                             backend=kind), 3)
+            self.assertEqual(collector.counter(
+                'eopayment_signature_failures_total', backend=kind), 1)
+            # dummy requests have no extra arguments
+            self.assertRaises(TypeError, list,
+                              payment.request_many([('10.00', None, None,
+                                                     {'language': 'fr'})],
+                                                   processes=processes))
+            self.assertEqual(collector.counter('eopayment_errors_total',
+                                               backend=kind,
+                                               operation='request'), 1)
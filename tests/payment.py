@@ -0,0 +1,94 @@
+from unittest import TestCase
+
+import eopayment
+from eopayment.store import MemoryNotificationStore
+
+OPTIONS = {
+    'siret': '1234',
+    'origin': 'test',
+    'direct_notification_url': 'http://example.com/notification',
+    'transaction_id_allocator': 'memory',
+}
+
+
+class PaymentTest(TestCase):
+    def test_response_many(self):
+        payment = eopayment.Payment(eopayment.DUMMY, dict(OPTIONS))
+        query_strings = ['transaction_id=%d&%s=1' % (i, 'ok' if i % 2 else 'nok')
+                         for i in range(25)]
+        for processes in (None, 2):
+            responses = payment.response_many(iter(query_strings),
+                                              processes=processes,
+                                              chunksize=3)
+            responses = list(responses)
+            self.assertEqual([r.order_id for r in responses],
+                             [str(i) for i in range(25)])
+            self.assertEqual([r.is_paid() for r in responses],
+                             [bool(i % 2) for i in range(25)])
+
+    def test_response_many_store(self):
+        query_strings = ['transaction_id=a&ok=1&signed=1'] * 3 \
+                + ['transaction_id=b&ok=1&signed=1']
+        for processes in (None, 2):
+            store = MemoryNotificationStore()
+            payment = eopayment.Payment(eopayment.DUMMY, dict(OPTIONS),
+                                        store=store)
+            responses = list(payment.response_many(query_strings,
+                                                   processes=processes,
+                                                   chunksize=2))
+            self.assertEqual([r.duplicate for r in responses],
+                             [False, True, True, False])
+            responses = list(payment.response_many(query_strings,
+                                                   processes=processes))
+            self.assertEqual([r.duplicate for r in responses], [True] * 4)
+
+    def test_request_many(self):
+        payment = eopayment.Payment(eopayment.DUMMY, dict(OPTIONS))
+        items = [('%d.00' % i, 'bob@example.com', None) for i in range(25)]
+        for processes in (None, 2):
+            results = list(payment.request_many(iter(items),
+                                                processes=processes,
+                                                chunksize=3))
+            self.assertEqual(len(results), 25)
+            self.assertEqual(len(set(r[0] for r in results)), 25)
+            for i, (transaction_id, kind, url) in enumerate(results):
+                self.assertEqual(kind, eopayment.URL)
+                self.assertTrue('transaction_id=%s' % transaction_id in url)
+                self.assertTrue('amount=%d.00' % i in url)
+
+    def test_request_many_extra(self):
+        payment = eopayment.Payment(eopayment.SYSTEMPAY, {
+            'secret_test': '2662931409789978', 'site_id': '93413345',
+            'ctx_mode': 'TEST', 'transaction_id_allocator': 'memory'})
+        results = list(payment.request_many([(10, None, None,
+                                              {'vads_language': 'en'})]))
+        self.assertTrue('vads_language=en' in results[0][2])
+
+    def test_get_backend(self):
+        import eopayment.dummy
+        self.assertTrue(eopayment.get_backend(eopayment.DUMMY)
+                        is eopayment.dummy.Payment)
+
+    def test_cache(self):
+        cache = eopayment.BackendCache(maxsize=2)
+        options = dict(OPTIONS)
+        first = eopayment.Payment(eopayment.DUMMY, options, cache=cache)
+        self.assertEqual(options, OPTIONS)
+        second = eopayment.Payment(eopayment.DUMMY, dict(OPTIONS), cache=cache)
+        self.assertTrue(first.backend is second.backend)
+        other_options = dict(OPTIONS, siret='5678')
+        other = eopayment.Payment(eopayment.DUMMY, other_options, cache=cache)
+        self.assertFalse(other.backend is first.backend)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 2, 2))
+        cache.invalidate(eopayment.DUMMY, other_options)
+        self.assertEqual(len(cache), 1)
+        eopayment.Payment(eopayment.DUMMY, dict(OPTIONS, siret='9'),
+                          cache=cache)
+        eopayment.Payment(eopayment.DUMMY, dict(OPTIONS, siret='10'),
+                          cache=cache)
+        # least recently used configuration was evicted
+        self.assertEqual(len(cache), 2)
+        again = eopayment.Payment(eopayment.DUMMY, dict(OPTIONS), cache=cache)
+        self.assertFalse(again.backend is first.backend)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
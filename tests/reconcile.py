@@ -0,0 +1,50 @@
+import json
+from unittest import TestCase
+
+import eopayment
+from eopayment import reconcile, sips
+
+from tests.payment import OPTIONS
+
+
+class ReconcileTest(TestCase):
+    def test_run(self):
+        payment = eopayment.Payment(eopayment.DUMMY, dict(OPTIONS))
+        log = [
+            'transaction_id=a&ok=1&signed=1',
+            'transaction_id=a&ok=1&signed=1',
+            json.dumps({'query_string': 'transaction_id=b&nok=1&signed=1'}),
+            '',
+            'transaction_id=c&ok=1',
+            'transaction_id=z&ok=1&signed=1',
+            '{"query_string": null}',
+            '{"other": "transaction_id=a&ok=1&signed=1"}',
+            '{"query_string": "transaction_id=a&ok=1',
+        ]
+        reconciliation = reconcile.Reconciliation(payment, set('abc'))
+        entries = list(reconciliation.run(log))
+        self.assertEqual([(e.status, e.order_id) for e in entries[:5]], [
+            (reconcile.PAID, 'a'),
+            (reconcile.DUPLICATE, 'a'),
+            (reconcile.UNPAID, 'b'),
+            (reconcile.INVALID_SIGNATURE, 'c'),
+            (reconcile.UNKNOWN, 'z')])
+        self.assertEqual([e.status for e in entries[5:8]],
+                         [reconcile.MALFORMED] * 3)
+        self.assertEqual(entries[5].line, '{"query_string": null}')
+        self.assertEqual(sorted((e.status, e.order_id) for e in entries[8:]),
+                         [(reconcile.MISSING, 'b'), (reconcile.MISSING, 'c')])
+        self.assertEqual(reconciliation.counts[reconcile.MISSING], 2)
+        self.assertEqual(reconciliation.counts[reconcile.PAID], 1)
+
+    def test_sips(self):
+        decoder = sips.FunctionDecoder(lambda data: {'code': '0',
+            'response_code': data[:2], 'order_id': data[2:],
+            'authorisation_id': '1'})
+        payment = eopayment.Payment(eopayment.SIPS, {'binpath': '/nonexistent',
+            'decoder': decoder, 'transaction_id_allocator': 'memory'})
+        reconciliation = reconcile.Reconciliation(payment,
+                                                  set(['ORDER1', 'ORDER2']))
+        entries = list(reconciliation.run(['DATA=00ORDER1']))
+        self.assertEqual([(e.status, e.order_id) for e in entries], [
+            (reconcile.PAID, 'ORDER1'), (reconcile.MISSING, 'ORDER2')])
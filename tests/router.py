@@ -0,0 +1,96 @@
+import os
+import os.path
+import shutil
+import tempfile
+from unittest import TestCase
+
+import eopayment
+from eopayment.router import PaymentRouter
+
+from tests.payment import OPTIONS
+
+
+def dummy(siret):
+    return eopayment.Payment(eopayment.DUMMY, dict(OPTIONS, siret=siret))
+
+
+def systempay(site_id):
+    return eopayment.Payment(eopayment.SYSTEMPAY, {
+        'secret_test': '1234567890123456', 'site_id': site_id,
+        'ctx_mode': 'TEST', 'transaction_id_allocator': 'memory'})
+
+
+def spplus(siret):
+    return eopayment.Payment(eopayment.SPPLUS, {
+        'cle': '58 6d fc 9c 34 91 9b 86 3f fd 64 63 c9 13 4a 26 ba 29 74 1e '
+               'c7 e9 80 79',
+        'siret': siret, 'transaction_id_allocator': 'memory'})
+
+
+class RouterTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_route(self):
+        payments = [dummy(str(i)) for i in range(10)] + \
+                   [systempay('%08d' % i) for i in range(10)]
+        router = PaymentRouter(payments)
+        self.assertEqual(len(router), 20)
+        self.assertTrue(router.route('transaction_id=1&siret=3&ok=1')
+                        is payments[3])
+        self.assertTrue(router.route('vads_amount=100&vads_site_id=00000007')
+                        is payments[17])
+        self.assertTrue(router.route('siret=42') is None)
+        self.assertRaises(ValueError, router.response, 'siret=42')
+        self.assertRaises(ValueError, router.add, dummy('3'))
+        router.remove(payments[3])
+        self.assertTrue(router.route('siret=3') is None)
+        response = router.response('transaction_id=1&siret=4&ok=1')
+        self.assertTrue(response.is_paid())
+
+    def test_kinds_sharing_field(self):
+        payments = [dummy('1234'), spplus('1234')]
+        router = PaymentRouter(payments)
+        self.assertEqual(len(router), 2)
+        self.assertRaises(ValueError, router.add, spplus('1234'))
+        self.assertTrue(router.route('siret=1234&transaction_id=1&ok=1')
+                        is payments[0])
+        self.assertTrue(router.route('siret=1234&reference=a&etat=1')
+                        is payments[1])
+        router.remove(payments[0])
+        self.assertTrue(router.route('siret=1234&transaction_id=1&ok=1')
+                        is payments[1])
+
+    def test_sips(self):
+        # each merchant kit only decodes the messages of its merchant
+        script = ('#!/bin/sh\n'
+                  'echo >> "$(dirname "$0")/calls"\n'
+                  'case "$1" in message=%s*) '
+                  'printf "0!!%s!fr!1000!000001" ;; esac\n')
+        payments = []
+        for prefix, merchant_id in (('A', '011111111111111'),
+                                    ('B', '022222222222222')):
+            binpath = os.path.join(self.path, prefix)
+            os.mkdir(binpath)
+            filename = os.path.join(binpath, 'response')
+            with open(filename, 'w') as f:
+                f.write(script % (prefix, merchant_id))
+            os.chmod(filename, 0755)
+            payments.append(eopayment.Payment(eopayment.SIPS, {
+                'binpath': binpath, 'merchant_id': merchant_id,
+                'transaction_id_allocator': 'memory'}))
+        router = PaymentRouter(payments)
+        self.assertTrue(router.route('DATA=A1') is payments[0])
+        self.assertTrue(router.route('DATA=B1') is payments[1])
+        response = router.response('DATA=B1')
+        self.assertEqual(response.bank_data['merchant_id'],
+                         '022222222222222')
+        # the kit of the first merchant ran once by routing, its failures
+        # on the messages of the second merchant were not restarted
+        with open(os.path.join(self.path, 'A', 'calls')) as f:
+            self.assertEqual(len(f.readlines()), 3)
+        self.assertTrue(router.route('DATA=C1') is None)
+        self.assertRaises(ValueError, router.response, 'DATA=C1')
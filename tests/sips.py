@@ -0,0 +1,117 @@
+import os.path
+import subprocess
+import threading
+import time
+from unittest import TestCase
+
+import eopayment
+import eopayment.sips as sips
+
+BINPATH = os.path.dirname(eopayment.__file__)
+
+
+class SipsTest(TestCase):
+    def test_request(self):
+        payment = sips.Payment({'binpath': BINPATH,
+                                'transaction_id_allocator': 'memory'})
+        order_id, kind, form = payment.request('10.00')
+        self.assertEqual(kind, eopayment.HTML)
+        self.assertEqual(form, 'coin')
+
+    def test_request_many_extra(self):
+        payment = eopayment.Payment(eopayment.SIPS, {'binpath': BINPATH,
+                                    'transaction_id_allocator': 'memory'})
+        executed = []
+        execute = payment.backend.execute
+        def record(executable, params, record):
+            executed.append(dict(params))
+            return execute(executable, params, record)
+        payment.backend.execute = record
+        results = list(payment.request_many([('10.00', None, None,
+                                              {'language': 'en'})]))
+        self.assertEqual(results[0][2], 'coin')
+        self.assertEqual(executed[0]['language'], 'en')
+        self.assertRaises(ValueError, list, payment.request_many(
+            [('10.00', None, None, {'unknown': '1'})]))
+
+    def test_pool_timeout(self):
+        pool = sips.ExecutionPool(timeout=0.2, retries=1)
+        start = time.time()
+        self.assertRaises(RuntimeError, pool.run, ['sleep', '5'])
+        self.assertTrue(time.time() - start < 2)
+        # output closed but still running
+        start = time.time()
+        self.assertRaises(RuntimeError, pool.run,
+                          ['sh', '-c', 'exec >&-; sleep 5'])
+        self.assertTrue(time.time() - start < 2)
+
+    def test_pool_kill_reaped(self):
+        pool = sips.ExecutionPool()
+        process = subprocess.Popen(['true'])
+        process.wait()
+        killed = []
+        process.kill = lambda: killed.append(process.pid)
+        pool.kill(process, threading.Lock())
+        self.assertEqual(killed, [])
+
+    def test_pool_shared(self):
+        self.assertTrue(sips.get_pool(4, 10, 0) is sips.get_pool(4, 10, 0))
+        payment = sips.Payment({'binpath': BINPATH, 'max_workers': '2'})
+        self.assertEqual(payment.pool.max_workers, 2)
+        self.assertFalse('max_workers' in payment.options)
+
+    def test_payment_reuse(self):
+        payment = sips.Payment({'binpath': BINPATH,
+                                'transaction_id_allocator': 'memory'})
+        for i in range(2):
+            self.assertEqual(payment.request('10.00')[2], 'coin')
+            response = payment.response('DATA=xxx')
+            self.assertEqual(response.bank_data['code'], 'xx=1')
+            self.assertFalse('merchant_id' in response.bank_data)
+
+    def test_execute_without_shell(self):
+        payment = sips.Payment({'binpath': BINPATH,
+                                'transaction_id_allocator': 'memory'})
+        payment.executables['response'] = '/bin/echo'
+        result = payment.execute('response', {'message': 'a b;$HOME!c'},
+                                 sips.ResponseResult)
+        self.assertEqual(result.code, 'message=a b;$HOME')
+        self.assertEqual(result.error, 'c\n')
+        self.assertEqual(result.data, None)
+
+    def test_parse_output(self):
+        result = sips.parse_output('!0!!<form>a!b</form>!',
+                                   sips.RequestResult)
+        self.assertEqual(result, ('0', '', '<form>a!b</form>'))
+        self.assertRaises(ValueError, sips.parse_output, '!',
+                          sips.RequestResult)
+
+    def test_function_decoder(self):
+        decoder = sips.FunctionDecoder(lambda data: {'code': '0',
+                                                     'response_code': '00',
+                                                     'order_id': data})
+        payment = sips.Payment({'binpath': '/nonexistent', 'decoder': decoder,
+                                'transaction_id_allocator': 'memory'})
+        response = payment.response('DATA=1234')
+        self.assertTrue(response.is_paid())
+        self.assertEqual(response.order_id, '1234')
+
+    def test_shadow_decoder(self):
+        same = sips.FunctionDecoder(lambda data: ['xx=1', 'yy=2'])
+        other = sips.FunctionDecoder(lambda data: ['xx=1', 'yy=3'])
+        def failing(data):
+            raise ValueError(data)
+        for candidate, mismatches, errors in ((same, 0, 0), (other, 1, 0),
+                (sips.FunctionDecoder(failing), 0, 1)):
+            shadow = sips.ShadowDecoder(candidate)
+            payment = sips.Payment({'binpath': BINPATH, 'decoder': shadow,
+                                    'transaction_id_allocator': 'memory'})
+            response = payment.response('DATA=xxx')
+            self.assertEqual(response.bank_data['error'], 'yy=2')
+            report = shadow.report()
+            self.assertEqual((report['sampled'], report['mismatches'],
+                              report['errors']), (1, mismatches, errors))
+        shadow = sips.ShadowDecoder(same, sample_rate=0)
+        sips.Payment({'binpath': BINPATH, 'decoder': shadow}).response(
+            'DATA=xxx')
+        self.assertEqual(shadow.report()['sampled'], 0)
@@ -14,3 +14,26 @@ class SPPlustTest(TestCase):
 
         for query, result in self.tests:
             self.assertEqual(spplus.sign_ntkey_query(self.ntkey, query).lower(), result)
+
+    def test_payment_signature(self):
+        payment = spplus.Payment({'cle': self.ntkey, 'siret': '00000000000001-01',
+            'transaction_id_allocator': 'memory'})
+        for query, result in self.tests:
+            self.assertEqual(spplus.sign_query(payment.hmac, query).lower(), result)
+        query = 'reference=abc&etat=10&refsfp=123'
+        signed_query = '%s&hmac=%s' % (query,
+                spplus.sign_ntkey_query(self.ntkey, query))
+        response = payment.response(signed_query)
+        self.assertTrue(response.signed)
+        self.assertTrue(response.is_paid())
+        self.assertFalse(payment.response(query + '&hmac=0000').signed)
+
+    def test_request_template(self):
+        payment = spplus.Payment({'cle': self.ntkey, 'siret': '00000000000001-01',
+            'transaction_id_allocator': 'memory'})
+        transaction_id, kind, url = payment.request('10.00',
+                email='bob@example.com', next_url='http://example.com/')
+        query, hmac = url.split('?', 1)[1].rsplit('&hmac=', 1)
+        self.assertEqual(hmac, spplus.sign_paiement(payment.hmac, query))
+        self.assertTrue(query.startswith(payment.static_query))
+        self.assertTrue('reference=%s' % transaction_id in query)
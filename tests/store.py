@@ -0,0 +1,83 @@
+import json
+import shutil
+import tempfile
+import urllib
+import urlparse
+from unittest import TestCase
+
+import eopayment
+from eopayment.common import PaymentResponse
+from eopayment.store import MemoryNotificationStore, SQLiteNotificationStore
+
+from tests.payment import OPTIONS as DUMMY_OPTIONS
+from tests.systempayv2 import OPTIONS, QUERY_STRING
+
+
+class NotificationStoreTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def check_store(self, store):
+        payment = eopayment.Payment(eopayment.DUMMY, dict(DUMMY_OPTIONS),
+                                    store=store)
+        response = payment.response('transaction_id=a&ok=1&signed=1')
+        self.assertFalse(response.duplicate)
+        again = payment.response('signed=1&transaction_id=a&ok=1')
+        self.assertTrue(again.duplicate)
+        self.assertTrue(again.is_paid())
+        self.assertEqual(again.bank_data, response.bank_data)
+        # another state of the same transaction
+        self.assertFalse(payment.response('transaction_id=a&nok=1&signed=1')
+                         .duplicate)
+        # unsigned responses are not stored
+        payment.response('transaction_id=b&ok=1')
+        self.assertFalse(payment.response('transaction_id=b&ok=1').duplicate)
+
+    def test_memory(self):
+        self.check_store(MemoryNotificationStore())
+
+    def test_sqlite(self):
+        store = SQLiteNotificationStore(self.path)
+        self.check_store(store)
+        self.assertEqual(store.purge(1), 0)
+        self.assertEqual(store.purge(-1), 2)
+
+    def test_sqlite_not_pickled(self):
+        import cPickle as pickle
+        store = SQLiteNotificationStore(self.path)
+        store.connection.execute('INSERT INTO notification VALUES (?, ?, ?)',
+            ('a', 0, buffer(pickle.dumps(PaymentResponse(),
+                                         pickle.HIGHEST_PROTOCOL))))
+        self.assertEqual(store.get(('a',)), None)
+        store.add(('b',), PaymentResponse(result=3,
+            signed=True, bank_data=lambda: {'x': ['1']}, order_id='o'))
+        row = store.connection.execute('SELECT response FROM notification '
+                                       'WHERE key = ?', ('b',)).fetchone()
+        self.assertEqual(json.loads(row[0])['bank_data'], {'x': ['1']})
+        response = store.get(('b',))
+        self.assertTrue(response.is_paid())
+        self.assertEqual(response.order_id, 'o')
+
+    def test_sites_sharing_store(self):
+        store = MemoryNotificationStore()
+        first = eopayment.Payment(eopayment.SYSTEMPAY, dict(OPTIONS),
+                                  store=store)
+        second = eopayment.Payment(eopayment.SYSTEMPAY,
+                                   dict(OPTIONS, site_id='12345678'),
+                                   store=store)
+        self.assertTrue(first.response(QUERY_STRING).is_paid())
+        # the same transaction refused on the other site
+        fields = dict(urlparse.parse_qsl(QUERY_STRING, True))
+        fields.update(vads_site_id='12345678', vads_auth_result='05',
+                      vads_result='05')
+        fields['signature'] = second.backend.signature(fields)
+        response = second.response(urllib.urlencode(fields))
+        self.assertTrue(response.signed)
+        self.assertFalse(response.duplicate)
+        self.assertFalse(response.is_paid())
+        # a notification of the first site given to the second one
+        self.assertFalse(second.response(QUERY_STRING).duplicate)
+        self.assertTrue(first.response(QUERY_STRING).duplicate)
@@ -0,0 +1,137 @@
+import urlparse
+from unittest import TestCase
+
+import eopayment.systempayv2 as systempayv2
+
+OPTIONS = {
+    'secret_test': '2662931409789978',
+    'site_id': '93413345',
+    'ctx_mode': 'TEST',
+    'transaction_id_allocator': 'memory',
+}
+
+QUERY_STRING = 'vads_amount=100&vads_auth_mode=FULL&vads_auth_number=767712&vads_auth_result=00&vads_capture_delay=0&vads_card_brand=CB&vads_card_number=497010XXXXXX0000&vads_payment_certificate=9da32cc109882089e1b3fb80888ebbef072f70b7&vads_ctx_mode=TEST&vads_currency=978&vads_effective_amount=100&vads_site_id=93413345&vads_trans_date=20120529132547&vads_trans_id=620594&vads_validation_mode=0&vads_version=V2&vads_warranty_result=NO&vads_payment_src=&vads_order_id=---&vads_cust_country=FR&vads_contrib=eopayment&vads_contract_used=2334233&vads_expiry_month=6&vads_expiry_year=2013&vads_pays_ip=FR&vads_identifier=&vads_subscription=&vads_threeds_enrolled=&vads_threeds_cavv=&vads_threeds_eci=&vads_threeds_xid=&vads_threeds_cavvAlgorithm=&vads_threeds_status=&vads_threeds_sign_valid=&vads_threeds_error_code=&vads_threeds_exit_status=&vads_result=00&vads_extra_result=&vads_card_country=FR&vads_language=fr&vads_action_mode=INTERACTIVE&vads_page_action=PAYMENT&vads_payment_config=SINGLE&signature=9c4f2bf905bb06b008b07090905adf36638d8ece&'
+
+
+class SystemPayTest(TestCase):
+    def test_request(self):
+        payment = systempayv2.Payment(dict(OPTIONS))
+        transaction_id, kind, url = payment.request(10,
+                email='bob@example.com', next_url='http://example.com/')
+        fields = dict((k, v[0]) for k, v in urlparse.parse_qs(
+            url.split('?', 1)[1], True).iteritems())
+        self.assertEqual(fields['vads_amount'], '1000')
+        self.assertEqual(fields['vads_site_id'], '93413345')
+        self.assertEqual(fields['vads_cust_email'], 'bob@example.com')
+        self.assertEqual(fields['vads_currency'], '978')
+        self.assertEqual(transaction_id, '%s_%s' % (fields['vads_trans_date'],
+                                                    fields['vads_trans_id']))
+        self.assertEqual(fields['signature'], payment.signature(fields))
+
+    def test_check_vads(self):
+        self.assertRaises(ValueError, systempayv2.check_vads, {})
+        fields = systempayv2.SCHEMA.merge_defaults(systempayv2.SCHEMA.defaults,
+                {'vads_amount': 100, 'vads_site_id': '12345678',
+                 'vads_trans_id': '000001'})
+        systempayv2.check_vads(fields)
+        fields['vads_currency'] = '97'
+        self.assertRaises(ValueError, systempayv2.check_vads, fields)
+
+    def test_response(self):
+        payment = systempayv2.Payment(dict(OPTIONS))
+        response = payment.response(QUERY_STRING)
+        self.assertTrue(response.signed)
+        self.assertTrue(response.is_paid())
+        self.assertEqual(response.order_id, '20120529132547_620594')
+        self.assertEqual(response.transaction_id, '767712')
+        response = payment.response(QUERY_STRING.replace('vads_amount=100',
+                                                         'vads_amount=1'))
+        self.assertFalse(response.signed)
+
+    def test_lazy_logging(self):
+        class RecordingLogger(object):
+            def __init__(self):
+                self.messages = []
+
+            def isEnabledFor(self, level):
+                return False
+
+            def debug(self, msg, *args):
+                self.messages.append(msg)
+
+        logger = RecordingLogger()
+        payment = systempayv2.Payment(dict(OPTIONS), logger=logger)
+        payment.response(QUERY_STRING)
+        payment.request(10)
+        # no per-field dump and no message formatted in advance
+        self.assertTrue(len(logger.messages) < 20)
+        for msg in logger.messages:
+            self.assertFalse('767712' in msg or 'vads_amount' in msg, msg)
+
+    def test_response_lazy_bank_data(self):
+        import pickle
+        payment = systempayv2.Payment(dict(OPTIONS))
+        response = payment.response(QUERY_STRING.replace('vads_result=00',
+                                                         'vads_result=05'))
+        self.assertTrue(callable(response._bank_data))
+        self.assertEqual(response.bank_data['vads_result'],
+                         '05: paiement refus\xc3\xa9')
+        self.assertEqual(response.bank_data['__bank_id'], '767712')
+        self.assertTrue('05: paiement' in response.bank_status)
+        self.assertRaises(AttributeError, setattr, response, 'result', None)
+        copy = pickle.loads(pickle.dumps(response))
+        self.assertEqual(copy.bank_data, response.bank_data)
+        self.assertEqual(copy.bank_status, response.bank_status)
+
+    def test_decode_status(self):
+        payment = systempayv2.Payment(dict(OPTIONS))
+        fields = {'vads_auth_result': '05', 'vads_result': '30',
+                  'vads_extra_result': '14'}
+        bank_data, bank_status = payment.decode(fields, True)
+        self.assertEqual(bank_data['vads_auth_result'], '05: Ne pas honorer')
+        self.assertEqual(bank_data['vads_extra_result'],
+                         'erreur dans le champ vads_order_info3')
+        self.assertEqual(bank_status.count('erreur dans le champ'), 3)
+        fields = {'vads_auth_result': 'XX', 'vads_result': '00',
+                  'vads_extra_result': 'YY'}
+        bank_data, bank_status = payment.decode(fields, False)
+        self.assertEqual(bank_status, 'XX: Code inconnu - 00: paiement '
+                         'r\xc3\xa9alis\xc3\xa9 avec succ\xc3\xa9s - '
+                         'YY: Code inconnu - invalid signature')
+
+    def test_signer(self):
+        payment = systempayv2.Payment(dict(OPTIONS))
+        fields = systempayv2.SCHEMA.merge_defaults(payment.defaults,
+                {'vads_amount': 100, 'vads_trans_id': '000001',
+                 'vads_url_return': 'http://example.com/'})
+        dynamic = dict((k, v) for k, v in fields.iteritems()
+                       if payment.defaults.get(k) != v)
+        self.assertEqual(payment.signer.sign(dynamic), payment.signature(fields))
+        # dynamic fields can override static ones
+        dynamic['vads_language'] = 'en'
+        fields['vads_language'] = 'en'
+        self.assertEqual(payment.signer.sign(dynamic), payment.signature(fields))
+
+    def test_verify(self):
+        payment = systempayv2.Payment(dict(OPTIONS))
+        self.assertTrue(payment.verify(QUERY_STRING))
+        self.assertFalse(payment.verify(QUERY_STRING.replace('vads_amount=100',
+                                                             'vads_amount=1')))
+        self.assertFalse(payment.verify('vads_amount=100'))
+
+    def test_request_template(self):
+        payment = systempayv2.Payment(dict(OPTIONS))
+        self.assertTrue(payment.static_valid)
+        transaction_id, kind, url = payment.request(10)
+        query = url.split('?', 1)[1]
+        self.assertTrue(query.startswith(payment.static_query))
+        fields = dict(urlparse.parse_qsl(query, True))
+        self.assertEqual(len(fields), len(query.split('&')))
+        self.assertEqual(fields['signature'], payment.signature(fields))
+        # overriding a static field encodes all the fields again
+        transaction_id, kind, url = payment.request(10, vads_language='en')
+        fields = dict(urlparse.parse_qsl(url.split('?', 1)[1], True))
+        self.assertEqual(fields['vads_language'], 'en')
+        self.assertEqual(fields['signature'], payment.signature(fields))
+        self.assertRaises(ValueError, payment.request, 10,
+                vads_currency='97')
@@ -0,0 +1,94 @@
+from unittest import TestCase
+
+import eopayment
+import eopayment.tracing as tracing
+
+from tests.systempayv2 import OPTIONS, QUERY_STRING
+
+
+class FakeSpan(object):
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.ended = False
+
+    def set_attributes(self, attributes):
+        self.attributes.update(attributes)
+
+
+class FakeManager(object):
+    def __init__(self, span):
+        self.span = span
+
+    def __enter__(self):
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.span.ended = True
+
+
+class FakeTracer(object):
+    def __init__(self):
+        self.spans = []
+
+    def start_as_current_span(self, name, attributes=None, start_time=None):
+        span = FakeSpan(name, attributes or {})
+        self.spans.append(span)
+        return FakeManager(span)
+
+
+class TracingTest(TestCase):
+    def test_stages(self):
+        recorder = tracing.Recorder()
+        payment = eopayment.Payment(eopayment.SYSTEMPAY, dict(OPTIONS),
+                                    tracer=recorder)
+        self.assertFalse('tracer' in payment.options)
+        payment.request(10)
+        stages = [(stage, depth) for stage, duration, depth
+                  in recorder.stages()]
+        self.assertEqual(stages, [('get_backend', 0), ('request', 0),
+                                  ('transaction_id', 1),
+                                  ('merge_defaults', 1), ('check_vads', 1),
+                                  ('signature', 1), ('urlencode', 1)])
+        recorder.clear()
+        payment.response(QUERY_STRING)
+        self.assertEqual([stage for stage, duration, depth
+                          in recorder.stages()],
+                         ['response', 'parse_qs', 'signature'])
+
+    def test_batches(self):
+        for processes in (None, 2):
+            recorder = tracing.Recorder()
+            payment = eopayment.Payment(eopayment.SYSTEMPAY, dict(OPTIONS),
+                                        tracer=recorder)
+            list(payment.request_many([(10, None, None)],
+                                      processes=processes))
+            list(payment.response_many([QUERY_STRING], processes=processes))
+            stages = [stage for stage, duration, depth in recorder.stages()
+                      if depth == 0]
+            self.assertEqual(stages, ['get_backend', 'request', 'response'])
+
+    def test_error(self):
+        recorder = tracing.Recorder()
+        payment = eopayment.Payment(eopayment.SYSTEMPAY, dict(OPTIONS),
+                                    tracer=recorder)
+        self.assertRaises(KeyError, payment.response, 'vads_amount=1')
+        event, stage, timestamp, attributes, thread = recorder.events[-1]
+        self.assertEqual((event, stage), ('end', 'response'))
+        self.assertTrue('KeyError' in attributes['error'])
+
+    def test_disabled(self):
+        self.assertTrue(tracing.stage(None, 'request')
+                        is tracing.NULL_STAGE)
+
+    def test_opentelemetry(self):
+        tracer = FakeTracer()
+        payment = eopayment.Payment(eopayment.SYSTEMPAY, dict(OPTIONS),
+                tracer=tracing.OpenTelemetryTracer(tracer))
+        payment.request(10)
+        self.assertEqual(tracer.spans[1].name, 'request')
+        self.assertEqual(tracer.spans[1].attributes['backend'],
+                         eopayment.SYSTEMPAY)
+        for span in tracer.spans:
+            self.assertTrue(span.ended)
+            self.assertTrue('duration' in span.attributes)